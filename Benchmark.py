@@ -0,0 +1,225 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import TetrisSIE
+from TetrisSIE import TetrisEnv, BitTetrisEnv
+
+# fixed seeds everywhere, two runs of the same revision measure the same work
+BOARD_SEED = 1234
+GAME_SEEDS = (17, 5132)
+FILL_HEIGHTS = {'empty': 0, 'mid': 10, 'near_full': 18}
+GEOMETRIES = ((20, 10), (40, 20), (20, 40))  # (rows, cols) of the board scaling cases
+
+
+def make_board(height, seed=BOARD_SEED, full_rows=0):
+    # bottom `height` rows ~70% filled and never full, plus full_rows full ones at the very bottom
+    rng = np.random.default_rng(seed)
+    board = np.zeros(TetrisEnv.TETRIS_GRID, dtype=np.byte)
+    if height:
+        board[-height:] = rng.random((height, TetrisEnv.MAX_TETRIS_COLS)) < 0.7
+        board[-height:][np.arange(height), rng.integers(0, TetrisEnv.MAX_TETRIS_COLS, height)] = 0
+    if full_rows:
+        board[-full_rows:] = 1
+    return board
+
+
+def measure(work, min_time, warm_up=True):
+    # (units per second, peak traced memory in KB) of calling work() until min_time has passed,
+    # work() returns how many units (placements, moves..) it did
+    if warm_up:
+        work()
+    units = 0
+    start = time.perf_counter()
+    while True:
+        units += work()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+    tracemalloc.start()
+    work()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return units / elapsed, peak / 1024
+
+
+def placement_cases():
+    cases = {}
+    for name, height in FILL_HEIGHTS.items():
+        board = make_board(height)
+        rows = TetrisSIE.board_to_rows(board)
+        plays = [(p, c, r) for p in TetrisEnv.TETRIS_PIECES for c in range(TetrisEnv.MAX_TETRIS_COLS)
+                 for r in range(4)]
+
+        def array_plays(env=TetrisEnv(), board=board, plays=plays):
+            for p, c, r in plays:
+                env.test_play(board.copy(), p, c, r)
+            return len(plays)
+
+        def row_plays(env=BitTetrisEnv(), rows=rows, plays=plays):
+            for p, c, r in plays:
+                env.test_play(rows, p, c, r)
+            return len(plays)
+
+        def batch_plays(env=TetrisEnv(), board=board):
+            for p in TetrisEnv.TETRIS_PIECES:
+                env.enumerate_placements(board, p)
+            return len(plays)  # what the same number of test_play calls would cover
+
+        cases['test_play/' + name] = (array_plays, 'placements/s')
+        cases['bit_test_play/' + name] = (row_plays, 'placements/s')
+        cases['enumerate_placements/' + name] = (batch_plays, 'placements/s')
+    return cases
+
+
+def collapse_cases():
+    cases = {}
+    env = TetrisEnv()
+    for lines in range(5):
+        board = make_board(12, full_rows=lines)
+
+        def collapse(env=env, board=board):
+            for _ in range(100):
+                env._TetrisEnv__collapse_rows(board.copy())
+            return 100
+
+        cases['collapse_rows/%d_lines' % lines] = (collapse, 'calls/s')
+    return cases
+
+
+def rating_cases():
+    board = make_board(FILL_HEIGHTS['mid'])
+    peaks = TetrisSIE.get_peaks(board)
+    ratings = {
+        'count_holes_t1': lambda: TetrisSIE.count_holes_t1(board),
+        'count_holes_t2': lambda: TetrisSIE.count_holes_t2(board),
+        'line_continuation': lambda: TetrisSIE.line_continuation(board),
+        'max_height': lambda: TetrisSIE.max_height(board),
+        'get_peaks': lambda: TetrisSIE.get_peaks(board),
+        'get_bumpiness': lambda: TetrisSIE.get_bumpiness(peaks),
+        'get_wells': lambda: TetrisSIE.get_wells(peaks),
+        'count_holes_n_cols_with_them': lambda: TetrisSIE.count_holes_n_cols_with_them(board),
+        'row_transition': lambda: TetrisSIE.row_transition(board),
+        'col_transition': lambda: TetrisSIE.col_transition(board),
+    }
+    cases = {}
+    for name, rate in ratings.items():
+        def rate_100(rate=rate):
+            for _ in range(100):
+                rate()
+            return 100
+
+        cases['rating/' + name] = (rate_100, 'boards/s')
+    # the whole registry over a 34 placement stack, like one move of eternal_batch
+    stack = np.repeat(board[None], 34, axis=0)
+
+    def all_features():
+        TetrisSIE.batch_features(stack, list(TetrisSIE.FEATURES))
+        return len(stack)
+
+    cases['batch_features/all'] = (all_features, 'boards/s')
+    return cases
+
+
+def game_cases(num_of_iters, random_iters):
+    def game(env_class, scoring_function, genetic_params, iters, seed):
+        def play():
+            random.seed(seed)  # random_scoring_function uses the global one
+            env = env_class()
+            env.set_seed(seed)
+            moves = 0
+            for _ in env.iter_run(scoring_function, genetic_params, iters):
+                moves += 1
+            return moves
+        return play
+
+    cases = {}
+    for seed in GAME_SEEDS:
+        cases['game/eternal/%d' % seed] = (game(TetrisEnv, TetrisSIE.eternal, TetrisSIE.eternal_chromo,
+                                                num_of_iters, seed), 'moves/s')
+        cases['game/bit_eternal_batch/%d' % seed] = (game(BitTetrisEnv, TetrisSIE.eternal_batch,
+                                                          TetrisSIE.eternal_chromo, num_of_iters, seed),
+                                                     'moves/s')
+        cases['game/random_scoring_function/%d' % seed] = (game(TetrisEnv, TetrisSIE.random_scoring_function,
+                                                                [1, 1, 2], random_iters, seed), 'moves/s')
+    return cases
+
+
+def geometry_cases(num_of_iters):
+    # eternal rates cols * 4 placements a move, placements/s should stay flat as the board grows
+    def game(rows, cols):
+        def play():
+            env = BitTetrisEnv(rows, cols)
+            moves = 0
+            for _ in env.iter_run(TetrisSIE.eternal, TetrisSIE.eternal_chromo, num_of_iters):
+                moves += 1
+            return moves * cols * 4
+        return play
+
+    return {'geometry/eternal/%dx%d' % (rows, cols): (game(rows, cols), 'placements/s') for rows, cols in GEOMETRIES}
+
+
+def run_benchmarks(min_time=0.5, num_of_iters=600, random_iters=100, only=None, verbose=True):
+    cases = {}
+    cases.update(placement_cases())
+    cases.update(collapse_cases())
+    cases.update(rating_cases())
+    cases.update(game_cases(num_of_iters, random_iters))
+    cases.update(geometry_cases(num_of_iters))
+    results = {}
+    for name, (work, unit) in cases.items():
+        if only and not any(part in name for part in only):
+            continue
+        if name.startswith(('game/', 'geometry/')):  # one timed game is enough
+            rate, peak = measure(work, 0, warm_up=False)
+        else:
+            rate, peak = measure(work, min_time)
+        results[name] = {'rate': rate, 'unit': unit, 'peak_kb': peak}
+        if verbose:
+            print('%-45s %14.1f %-13s peak %9.1f KB' % (name, rate, unit, peak))
+    return results
+
+
+def save(results, path):
+    info = {'python': sys.version.split()[0], 'numpy': np.__version__, 'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+    with open(path, 'w') as f:
+        json.dump(info, f, indent=1, sort_keys=True)
+
+
+def compare(old_path, new_path, tolerance=0.1):
+    # prints new/old speed of every common case, returns the names that got slower than tolerance
+    with open(old_path) as f:
+        old = json.load(f)['results']
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    slower = []
+    for name in sorted(set(old) & set(new)):
+        ratio = new[name]['rate'] / old[name]['rate']
+        mark = ''
+        if ratio < 1 - tolerance:
+            mark = '  <-- regression'
+            slower.append(name)
+        print('%-45s %8.2fx%s' % (name, ratio, mark))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='TetrisSIE benchmarks')
+    parser.add_argument('--out', default='bench_results.json', help='where to save the results')
+    parser.add_argument('--min-time', type=float, default=0.5, help='seconds per micro benchmark')
+    parser.add_argument('--iters', type=int, default=600, help='pieces per eternal game')
+    parser.add_argument('--random-iters', type=int, default=100, help='pieces per random_scoring_function game')
+    parser.add_argument('--only', nargs='*', help='run only cases whose name contains one of these')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown reported as a regression')
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.tolerance) else 0)
+    save(run_benchmarks(args.min_time, args.iters, args.random_iters, args.only), args.out)
@@ -0,0 +1,123 @@
+import argparse
+
+import numpy as np
+
+import TetrisSIE
+from Genetic import GeneticTrainer
+
+
+# CMA-ES (Hansen's (mu/mu_w, lambda) version) over the chromosome: every generation is one
+# (lambda, genes) matrix sampled from N(mean, sigma^2 C), its games go through GeneticTrainer's
+# evaluate (pool, coordinator, fitness cache) and mean, C and sigma are updated with a few matrix
+# products on the mu best. Good weight vectors are found with a handful of small generations
+# where the GA needs a big population, and only the ranking of the scores matters
+class CMAESTrainer(GeneticTrainer):
+    def __init__(self, scoring_name='eternal_batch', num_of_genes=5, population_size=16, num_of_iters=600,
+                 seeds=(17,), mean=None, sigma=10.0, processes=None, env_name='BitTetrisEnv', rng_seed=None,
+                 pieces_dir=None, coordinator=None, fitness_cache=None, population=None):
+        # population is only the last sampled generation (for resume), step() samples a new one
+        n = num_of_genes
+        # the usual 4 + 3 ln(genes) (8 here) is too few for scores this flat, 16 beat eternal_chromo
+        lam = population_size
+        super().__init__(scoring_name, n, lam, num_of_iters, seeds, elite_count=0, processes=processes,
+                         env_name=env_name, rng_seed=rng_seed,
+                         population=np.zeros((0, n)) if population is None else population, pieces_dir=pieces_dir,
+                         coordinator=coordinator, fitness_cache=fitness_cache)
+        # what resume builds the trainer with, the distribution itself comes from the checkpoint
+        self.config = {'scoring_name': scoring_name, 'num_of_genes': n, 'population_size': population_size,
+                       'num_of_iters': num_of_iters, 'seeds': list(seeds), 'sigma': sigma, 'processes': processes,
+                       'env_name': env_name, 'pieces_dir': pieces_dir,
+                       'fitness_cache': fitness_cache if isinstance(fitness_cache, str) else None}
+        self.population_size = lam
+        self.mean = np.zeros(n) if mean is None else np.array(mean, dtype=float)
+        self.sigma = sigma
+        # recombination weights of the mu best and the learning rates, the defaults of the tutorial
+        self.mu = lam // 2
+        weights = np.log(self.mu + 0.5) - np.log(np.arange(1, self.mu + 1))
+        self.weights = weights / weights.sum()
+        self.mu_eff = 1 / np.sum(self.weights ** 2)
+        self.c_sigma = (self.mu_eff + 2) / (n + self.mu_eff + 5)
+        self.d_sigma = 1 + 2 * max(0.0, np.sqrt((self.mu_eff - 1) / (n + 1)) - 1) + self.c_sigma
+        self.c_c = (4 + self.mu_eff / n) / (n + 4 + 2 * self.mu_eff / n)
+        self.c_1 = 2 / ((n + 1.3) ** 2 + self.mu_eff)
+        self.c_mu = min(1 - self.c_1, 2 * (self.mu_eff - 2 + 1 / self.mu_eff) / ((n + 2) ** 2 + self.mu_eff))
+        self.chi_n = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n * n))  # E|N(0, I)|
+        self.cov = np.eye(n)
+        self.p_sigma = np.zeros(n)
+        self.p_c = np.zeros(n)
+        # best chromosome of any generation, generations don't keep elites
+        self.best_chromo = None
+        self.best_fitness = -np.inf
+
+    def step(self):
+        n = len(self.mean)
+        eigvals, basis = np.linalg.eigh(self.cov)
+        z = self.rng.standard_normal((self.population_size, n))
+        y = (z * np.sqrt(np.maximum(eigvals, 0))) @ basis.T  # rows ~ N(0, C)
+        self.population = self.mean + self.sigma * y
+        self.seed_scores = self.evaluate(self.population)
+        self.fitness = self.seed_scores.mean(axis=1)
+        top = np.argsort(-self.fitness, kind='stable')
+        if self.fitness[top[0]] > self.best_fitness:
+            self.best_chromo = self.population[top[0]].tolist()
+            self.best_fitness = float(self.fitness[top[0]])
+        top = top[:self.mu]
+        y_w = self.weights @ y[top]
+        self.mean = self.mean + self.sigma * y_w
+        # C^-1/2 y_w is just basis @ z_w
+        self.p_sigma = (1 - self.c_sigma) * self.p_sigma + \
+            np.sqrt(self.c_sigma * (2 - self.c_sigma) * self.mu_eff) * (basis @ (self.weights @ z[top]))
+        norm = np.linalg.norm(self.p_sigma)
+        # p_c stalls while p_sigma is long, so C doesn't grow too fast when sigma is too small
+        h_sigma = norm / np.sqrt(1 - (1 - self.c_sigma) ** (2 * (self.generation + 1))) < \
+            (1.4 + 2 / (n + 1)) * self.chi_n
+        self.p_c = (1 - self.c_c) * self.p_c + h_sigma * np.sqrt(self.c_c * (2 - self.c_c) * self.mu_eff) * y_w
+        rank_mu = (y[top].T * self.weights) @ y[top]
+        self.cov = (1 - self.c_1 - self.c_mu) * self.cov + self.c_mu * rank_mu + \
+            self.c_1 * (np.outer(self.p_c, self.p_c) + (1 - h_sigma) * self.c_c * (2 - self.c_c) * self.cov)
+        self.cov = (self.cov + self.cov.T) / 2
+        self.sigma *= np.exp(self.c_sigma / self.d_sigma * (norm / self.chi_n - 1))
+        self.generation += 1
+        self.history.append((float(self.fitness.max()), float(self.fitness.mean())))
+        return self.best()
+
+    def best(self):
+        return self.best_chromo, self.best_fitness
+
+    def checkpoint_arrays(self):
+        arrays = super().checkpoint_arrays()
+        arrays.update(mean=self.mean, sigma=self.sigma, cov=self.cov, p_sigma=self.p_sigma, p_c=self.p_c,
+                      best_fitness=self.best_fitness)
+        if self.best_chromo is not None:
+            arrays['best_chromo'] = self.best_chromo
+        return arrays
+
+    def load_checkpoint_arrays(self, data):
+        super().load_checkpoint_arrays(data)
+        self.mean = data['mean']
+        self.sigma = float(data['sigma'])
+        self.cov = data['cov']
+        self.p_sigma = data['p_sigma']
+        self.p_c = data['p_c']
+        self.best_fitness = float(data['best_fitness'])
+        if 'best_chromo' in data:
+            self.best_chromo = data['best_chromo'].tolist()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='tune eternal_batch weights with CMA-ES')
+    parser.add_argument('--generations', type=int, default=25)
+    parser.add_argument('--population', type=int, default=16, help='samples per generation')
+    parser.add_argument('--sigma', type=float, default=10.0)
+    parser.add_argument('--checkpoint', help='save the trainer here after every generation')
+    parser.add_argument('--resume', action='store_true', help='carry on from --checkpoint')
+    args = parser.parse_args()
+    if args.resume:
+        trainer = CMAESTrainer.resume(args.checkpoint)
+    else:
+        trainer = CMAESTrainer('eternal_batch', population_size=args.population, num_of_iters=300,
+                               seeds=(17, 5132, 4), sigma=args.sigma, rng_seed=0)
+    with trainer:
+        print(trainer.train(args.generations, checkpoint_path=args.checkpoint))
+        print(trainer.pieces_played, 'pieces played, eternal_chromo gets',
+              trainer.evaluate(np.array([TetrisSIE.eternal_chromo])).mean())
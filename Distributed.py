@@ -0,0 +1,215 @@
+import argparse
+import ipaddress
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from multiprocessing.connection import Listener, Client
+
+import TetrisSIE
+
+# coordinator / worker over multiprocessing.connection (pickled messages on a TCP socket, the
+# authkey is checked with HMAC on connect). Pickles run code when loaded, so only on a network
+# where every node is trusted.
+# A task is (scoring_name, env_name, chromosome, seed, num_of_iters), its result (score, pieces).
+# Protocol, coordinator -> worker: ('batch', tasks) or ('stop',), worker -> coordinator: the list
+# of results of the last batch. A worker that disconnects or takes longer than timeout on a
+# batch is dropped and its batch goes back to the front of the queue for the others.
+# There is no shared default authkey: it's the authkey argument, else TETRIS_AUTHKEY, else (on
+# loopback only) this process's random multiprocessing authkey, which the local worker processes
+# it starts inherit
+
+
+def is_loopback(address):
+    host = address[0] if isinstance(address, tuple) else None
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def get_authkey(address, authkey=None):
+    if authkey is None and os.environ.get('TETRIS_AUTHKEY'):
+        authkey = os.environ['TETRIS_AUTHKEY'].encode()
+    if authkey is None:
+        if not is_loopback(address):
+            raise ValueError('%r is not loopback, pass an authkey or set TETRIS_AUTHKEY' % (address,))
+        authkey = multiprocessing.current_process().authkey
+    return authkey
+
+
+def run_worker(address, authkey=None):
+    # plays batches until the coordinator says stop or goes away, one env per env_name
+    envs = {}
+    with Client(address, authkey=get_authkey(address, authkey)) as conn:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                return
+            if message[0] == 'stop':
+                return
+            results = []
+            for scoring_name, env_name, chromo, seed, num_of_iters in message[1]:
+                env = envs.get(env_name)
+                if env is None:
+                    env = envs[env_name] = getattr(TetrisSIE, env_name)()
+                env.set_seed(seed)
+                score, _, _ = env.run(getattr(TetrisSIE, scoring_name), chromo, num_of_iters, False)
+                results.append((float(score), env.pieces_drawn - 2))
+            try:
+                conn.send(results)
+            except OSError:  # dropped (too slow or the coordinator closed), its batch went to others
+                return
+
+
+class Coordinator:
+    # hands out queued tasks in batches of batch_size to every connected worker (one thread per
+    # worker, one batch in flight each). evaluate() blocks until all its tasks have results or
+    # there has been no worker at all for worker_wait seconds
+    def __init__(self, address=('localhost', 0), authkey=None, batch_size=8, timeout=None, worker_wait=60.0):
+        self.listener = Listener(address, authkey=get_authkey(address, authkey))
+        self.address = self.listener.address
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.worker_wait = worker_wait
+        self.pending = deque()  # (key, task)
+        self.results = {}
+        self.next_key = 0
+        self.workers = 0
+        self.reassigned = 0  # tasks that went back to the queue because their worker was lost
+        self.closed = False
+        self.lock = threading.Condition()
+        threading.Thread(target=self.__accept, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __accept(self):
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                if self.closed:
+                    return
+                continue
+            threading.Thread(target=self.__serve, args=(conn,), daemon=True).start()
+
+    def __serve(self, conn):
+        with self.lock:
+            self.workers += 1
+            self.lock.notify_all()
+        batch = None
+        try:
+            while True:
+                with self.lock:
+                    while not self.pending and not self.closed:
+                        self.lock.wait()
+                    if self.closed:
+                        conn.send(('stop',))
+                        return
+                    batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+                conn.send(('batch', [task for _, task in batch]))
+                if self.timeout is not None and not conn.poll(self.timeout):
+                    raise TimeoutError('worker took longer than %s s on a batch' % self.timeout)
+                results = conn.recv()
+                with self.lock:
+                    for (key, _), result in zip(batch, results):
+                        self.results[key] = result
+                    batch = None
+                    self.lock.notify_all()
+        except (OSError, EOFError, TimeoutError):
+            pass  # lost this worker
+        finally:
+            with self.lock:
+                if batch:
+                    self.pending.extendleft(reversed(batch))
+                    self.reassigned += len(batch)
+                self.workers -= 1
+                self.lock.notify_all()
+            conn.close()
+
+    def evaluate(self, tasks):
+        # results of tasks, in order. Raises RuntimeError once there has been no worker for
+        # worker_wait seconds (none connected, or all of them lost) with tasks still to play
+        with self.lock:
+            keys = list(range(self.next_key, self.next_key + len(tasks)))
+            self.next_key += len(tasks)
+            self.pending.extend(zip(keys, tasks))
+            self.lock.notify_all()
+            no_workers_since = None
+            while not all(key in self.results for key in keys):
+                if self.workers:
+                    no_workers_since = None
+                elif no_workers_since is None:
+                    no_workers_since = time.monotonic()
+                elif time.monotonic() - no_workers_since >= self.worker_wait:
+                    # these tasks won't be played, don't hand them to a worker that comes later
+                    dropped = set(keys)
+                    self.pending = deque(item for item in self.pending if item[0] not in dropped)
+                    missing = sum(self.results.pop(key, None) is None for key in keys)
+                    raise RuntimeError('no workers for %s s, %d of %d tasks not played'
+                                       % (self.worker_wait, missing, len(keys)))
+                self.lock.wait(None if self.workers else min(1.0, self.worker_wait))
+            return [self.results.pop(key) for key in keys]
+
+    def wait_for_workers(self, count, timeout=None):
+        with self.lock:
+            return self.lock.wait_for(lambda: self.workers >= count, timeout)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.listener.close()
+
+
+def parse_address(text):
+    host, port = text.rsplit(':', 1)
+    return host, int(port)
+
+
+def demo(num_of_workers, num_of_tasks, num_of_iters):
+    # local processes standing in for nodes, one of them killed mid run
+    with Coordinator(batch_size=4, timeout=60) as coordinator:
+        workers = [multiprocessing.Process(target=run_worker, args=(coordinator.address,))
+                   for _ in range(num_of_workers)]
+        for w in workers:
+            w.start()
+        coordinator.wait_for_workers(num_of_workers)
+        tasks = [('eternal_batch', 'BitTetrisEnv', TetrisSIE.eternal_chromo, seed, num_of_iters)
+                 for seed in range(num_of_tasks)]
+        threading.Timer(1.0, workers[0].kill).start()
+        start = time.perf_counter()
+        results = coordinator.evaluate(tasks)
+        print('%d games in %.2f s, %d tasks reassigned' % (len(results), time.perf_counter() - start,
+                                                           coordinator.reassigned))
+        print([score for score, _ in results])
+    for w in workers:
+        w.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='distributed fitness evaluation')
+    sub = parser.add_subparsers(dest='command', required=True)
+    worker = sub.add_parser('worker', help='play batches for a coordinator')
+    worker.add_argument('address', help='coordinator HOST:PORT')
+    worker.add_argument('--authkey', default=os.environ.get('TETRIS_AUTHKEY'),
+                        help="the coordinator's, default TETRIS_AUTHKEY")
+    local = sub.add_parser('demo', help='coordinator and local workers on this machine')
+    local.add_argument('--workers', type=int, default=3)
+    local.add_argument('--tasks', type=int, default=24)
+    local.add_argument('--iters', type=int, default=300)
+    args = parser.parse_args()
+    if args.command == 'worker':
+        if not args.authkey:  # a separate worker never shares the coordinator's random key
+            parser.error('worker needs --authkey or TETRIS_AUTHKEY')
+        run_worker(parse_address(args.address), args.authkey.encode())
+    else:
+        demo(args.workers, args.tasks, args.iters)
@@ -0,0 +1,61 @@
+import argparse
+import json
+import sys
+import time
+
+import TetrisSIE
+
+# headless evaluator for batch jobs: plays every chromosome on every seed and prints one JSON
+# line per game as soon as it is done. Only TetrisSIE (numpy) is imported, never Visor/tkinter,
+# and games go through iter_run so the lose message run builds is never made
+#   python Evaluate.py --scoring eternal_batch --seeds 17 5132 --iters 600 --chromo "[-10, -5, 0.5, 1, 1]"
+#   python Evaluate.py --chromos chromos.jsonl   (one JSON list per line, - for stdin)
+
+
+def read_chromos(path):
+    with (sys.stdin if path == '-' else open(path)) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def evaluate(env, scoring_function, chromo, seed, num_of_iters):
+    env.set_seed(seed)
+    start = time.perf_counter()
+    pieces = 0
+    lost = False
+    for step in env.iter_run(scoring_function, chromo, num_of_iters):
+        pieces += 1
+        lost = step.play_score < 0
+    return {'chromo': chromo, 'seed': seed, 'iters': num_of_iters, 'score': int(env.score), 'pieces': pieces,
+            'lost': lost, 'seconds': round(time.perf_counter() - start, 4)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='evaluate chromosomes headless, one JSON line per game')
+    parser.add_argument('--scoring', default='eternal_batch', help='scoring function name in TetrisSIE')
+    parser.add_argument('--env', default='BitTetrisEnv', choices=('TetrisEnv', 'BitTetrisEnv'))
+    parser.add_argument('--seeds', type=int, nargs='+', default=[17])
+    parser.add_argument('--iters', type=int, default=600, help='piece budget per game')
+    parser.add_argument('--chromo', action='append', type=json.loads, default=[],
+                        help='a chromosome as a JSON list, can be given many times')
+    parser.add_argument('--chromos', help='file of JSON list chromosomes, one per line (- for stdin)')
+    parser.add_argument('--rows', type=int, help='board rows (without the game over ones)')
+    parser.add_argument('--cols', type=int, help='board columns')
+    args = parser.parse_args(argv)
+    scoring_function = getattr(TetrisSIE, args.scoring, None)
+    if not callable(scoring_function):
+        parser.error('no scoring function %r in TetrisSIE' % args.scoring)
+    env = getattr(TetrisSIE, args.env)(args.rows, args.cols)
+    chromos = list(args.chromo)
+    if args.chromos:
+        chromos = (c for source in (chromos, read_chromos(args.chromos)) for c in source)
+    elif not chromos:
+        chromos = [TetrisSIE.eternal_chromo]
+    for chromo in chromos:
+        for seed in args.seeds:
+            print(json.dumps(evaluate(env, scoring_function, chromo, seed, args.iters)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+import TetrisSIE
+
+# games are deterministic for (chromosome, scoring function, env, seed, piece budget), so their
+# (score, pieces played) are kept in a sqlite file and reused across generations, restarts and
+# processes. Every result is stamped with a hash of TetrisSIE.py (engine and scoring functions
+# both live there), results of any other version of the code are never used and dropped on open.
+# WAL mode lets any number of processes read while one writes, writers wait busy_timeout for
+# each other. Past max_entries the least recently used results are evicted
+NONDETERMINISTIC = {'random_scoring_function'}  # uses the global random, never cached
+
+
+def code_stamp():
+    with open(TetrisSIE.__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+def cache_key(scoring_name, env_name, chromo, seed, num_of_iters):
+    return scoring_name, env_name, np.asarray(chromo, dtype=np.float64).tobytes(), str(seed), int(num_of_iters)
+
+
+class FitnessCache:
+    def __init__(self, path, max_entries=1000000, stamp=None, busy_timeout=30.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.stamp = stamp or code_stamp()
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS results (stamp TEXT, scoring TEXT, env TEXT, '
+                              'chromo BLOB, seed TEXT, iters INTEGER, score REAL, pieces INTEGER, '
+                              'last_used REAL, PRIMARY KEY (stamp, scoring, env, chromo, seed, iters))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS by_use ON results (last_used)')
+            self.conn.execute('DELETE FROM results WHERE stamp != ?', (self.stamp,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def cacheable(scoring_name):
+        return scoring_name not in NONDETERMINISTIC
+
+    def get_many(self, keys):
+        # (score, pieces) of every key, None where there is none
+        found = []
+        used = []
+        for key in keys:
+            row = self.conn.execute('SELECT score, pieces FROM results WHERE stamp = ? AND scoring = ? AND env = ? '
+                                    'AND chromo = ? AND seed = ? AND iters = ?', (self.stamp,) + key).fetchone()
+            found.append(row)
+            if row is not None:
+                used.append((time.time(),) + (self.stamp,) + key)
+        self.hits += len(used)
+        self.misses += len(keys) - len(used)
+        if used:
+            with self.conn:
+                self.conn.execute('BEGIN IMMEDIATE')
+                self.conn.executemany('UPDATE results SET last_used = ? WHERE stamp = ? AND scoring = ? AND env = ? '
+                                      'AND chromo = ? AND seed = ? AND iters = ?', used)
+        return found
+
+    def put_many(self, items):
+        # items are (key, (score, pieces))
+        now = time.time()
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                  [(self.stamp,) + key + (float(score), int(pieces), now)
+                                   for key, (score, pieces) in items])
+            count = self.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            if count > self.max_entries:
+                # down to 90% so eviction doesn't run on every put once full
+                self.conn.execute('DELETE FROM results WHERE rowid IN (SELECT rowid FROM results '
+                                  'ORDER BY last_used LIMIT ?)', (count - self.max_entries * 9 // 10,))
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def stats(self):
+        return {'entries': len(self), 'hits': self.hits, 'misses': self.misses,
+                'bytes': sum(os.path.getsize(p) for p in (self.path, self.path + '-wal') if os.path.exists(p))}
@@ -0,0 +1,352 @@
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+
+import numpy as np
+
+import TetrisSIE
+from FitnessCache import FitnessCache, cache_key
+
+# region workers
+# every worker process keeps one env for its whole life, only (chromosome, seed) goes in and a
+# score comes out. Scoring functions are passed by name so closures like eternal_batch work too
+worker_env = None
+worker_scoring = None
+worker_iters = 0
+
+
+def init_worker(scoring_name, num_of_iters, env_name, pieces_dir=None):
+    global worker_env, worker_scoring, worker_iters
+    worker_env = getattr(TetrisSIE, env_name)()
+    if pieces_dir is not None:  # the trainer already made the files, these are just memmaps
+        worker_env.piece_source = TetrisSIE.PieceSequences(pieces_dir, num_of_iters + 2)
+    worker_scoring = getattr(TetrisSIE, scoring_name)
+    worker_iters = num_of_iters
+
+
+def play_game(task):
+    chromo, seed = task
+    worker_env.set_seed(seed)
+    score, _, _ = worker_env.run(worker_scoring, chromo, worker_iters, False)
+    return float(score), worker_env.pieces_drawn - 2
+
+
+def play_race(task):
+    # plays `pieces` more pieces of a game (a new one if state is None), stops it early once even
+    # rate_cap points per piece for the rest of the full budget can't reach target.
+    # Returns (score, state to carry on from, finished (lost or cut), pieces played)
+    chromo, seed, state, pieces, target, rate_cap, remaining_after = task
+    if state is None:
+        worker_env.set_seed(seed)
+        game = worker_env.iter_run(worker_scoring, chromo, pieces)
+    else:
+        worker_env.set_state(state)
+        game = worker_env.iter_run(worker_scoring, chromo, pieces, restart=False)
+    played = 0
+    finished = False
+    for step in game:
+        played += 1
+        if step.play_score < 0:
+            finished = True
+        elif target is not None and step.score + (pieces - played + remaining_after) * rate_cap < target:
+            finished = True
+            game.close()
+            break
+    return float(worker_env.score), worker_env.get_state(), finished, played
+
+
+# endregion
+
+
+class GeneticTrainer:
+    # fitness of a chromosome is its mean score over seeds, every game is
+    # env.run(scoring_function, chromo, num_of_iters, False) on one of the pool's workers
+    def __init__(self, scoring_name='eternal', num_of_genes=5, population_size=200, num_of_iters=600,
+                 seeds=(17,), elite_count=4, tournament_size=3, crossover_rate=0.9, mutation_rate=0.2,
+                 mutation_scale=1.0, init_scale=5.0, processes=None, env_name='TetrisEnv', rng_seed=None,
+                 population=None, racing_budgets=None, keep_fraction=1 / 3, cutoff_slack=3.0, pieces_dir=None,
+                 coordinator=None, fitness_cache=None):
+        # a bad name fails here and not in every worker, a pool respawns failing workers forever
+        for name in (scoring_name, env_name):
+            if not callable(getattr(TetrisSIE, name, None)):
+                raise ValueError('no %r in TetrisSIE' % name)
+        # everything resume needs to build the same trainer again
+        self.config = {'scoring_name': scoring_name, 'num_of_iters': num_of_iters, 'seeds': list(seeds),
+                       'elite_count': elite_count, 'tournament_size': tournament_size,
+                       'crossover_rate': crossover_rate, 'mutation_rate': mutation_rate,
+                       'mutation_scale': mutation_scale, 'processes': processes, 'env_name': env_name,
+                       'racing_budgets': list(racing_budgets) if racing_budgets else None,
+                       'keep_fraction': keep_fraction, 'cutoff_slack': cutoff_slack, 'pieces_dir': pieces_dir,
+                       'fitness_cache': fitness_cache if isinstance(fitness_cache, str) else None}
+        self.scoring_name = scoring_name
+        self.env_name = env_name
+        self.num_of_iters = num_of_iters
+        self.seeds = list(seeds)
+        self.elite_count = elite_count
+        self.tournament_size = tournament_size
+        self.crossover_rate = crossover_rate
+        self.mutation_rate = mutation_rate
+        self.mutation_scale = mutation_scale
+        # racing: every chromosome plays racing_budgets[0] pieces per seed, only the best
+        # keep_fraction carry on to the next budget, up to racing_budgets[-1] (num_of_iters)
+        self.racing_budgets = list(racing_budgets) if racing_budgets else None
+        if self.racing_budgets:
+            self.racing_budgets[-1] = num_of_iters
+        self.keep_fraction = keep_fraction
+        self.cutoff_slack = cutoff_slack
+        self.pieces_played = 0
+        # a Distributed.Coordinator plays the games on its workers instead of the pool
+        self.coordinator = coordinator
+        if coordinator is not None and self.racing_budgets:
+            raise ValueError('racing needs the local pool, not a coordinator')
+        # full games already played (by any run of the same code) come from the cache (a
+        # FitnessCache or its path), racing games are never cached
+        if isinstance(fitness_cache, str):
+            fitness_cache = FitnessCache(fitness_cache)
+        if fitness_cache is not None and not fitness_cache.cacheable(scoring_name):
+            fitness_cache = None
+        self.fitness_cache = fitness_cache
+        self.rng = np.random.default_rng(rng_seed)
+        if population is None:
+            population = self.rng.uniform(-init_scale, init_scale, (population_size, num_of_genes))
+        self.population = np.array(population, dtype=float)
+        self.fitness = None
+        self.seed_scores = None
+        self.generation = 0
+        self.history = []  # (best, mean) fitness after every generation
+        self.processes = 1 if coordinator is not None else processes or multiprocessing.cpu_count()
+        # with pieces_dir every seed's pieces are made once here and read by all the workers
+        if pieces_dir is not None:
+            sequences = TetrisSIE.PieceSequences(pieces_dir, num_of_iters + 2)
+            for seed in self.seeds:
+                sequences.get(seed, num_of_iters + 2)
+        init_args = (scoring_name, num_of_iters, env_name, pieces_dir)
+        if self.processes > 1:
+            self.pool = multiprocessing.Pool(self.processes, init_worker, init_args)
+        else:  # same worker code, just in this process
+            self.pool = None
+            init_worker(*init_args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.fitness_cache is not None:
+            self.fitness_cache.close()
+            self.fitness_cache = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __map(self, func, tasks):
+        if self.pool is None:
+            return list(map(func, tasks))
+        return self.pool.map(func, tasks, chunksize=1)
+
+    def evaluate(self, population, elite_scores=None):
+        # (P, S) scores of every chromosome on every seed
+        if self.racing_budgets:
+            return self.race(population, elite_scores)
+        games = [(chromo, seed) for chromo in population.tolist() for seed in self.seeds]
+        results = [None] * len(games)
+        if self.fitness_cache is not None:
+            keys = [cache_key(self.scoring_name, self.env_name, chromo, seed, self.num_of_iters)
+                    for chromo, seed in games]
+            results = self.fitness_cache.get_many(keys)
+        todo = [g for g, result in enumerate(results) if result is None]
+        if self.coordinator is not None:
+            played = self.coordinator.evaluate([(self.scoring_name, self.env_name, chromo, seed, self.num_of_iters)
+                                                for chromo, seed in (games[g] for g in todo)])
+        else:
+            played = self.__map(play_game, [games[g] for g in todo])
+        for g, result in zip(todo, played):
+            results[g] = result
+        if self.fitness_cache is not None and todo:
+            self.fitness_cache.put_many([(keys[g], results[g]) for g in todo])
+        self.pieces_played += sum(pieces for _, pieces in played)
+        return np.array([score for score, _ in results]).reshape(len(population), len(self.seeds))
+
+    def race(self, population, elite_scores=None):
+        # successive halving over racing_budgets, games carry on where the last budget stopped.
+        # A partial score can beat a full one (losing later costs GAMEOVER_PENALTY), so the scores
+        # of the chromosomes dropped after a budget are all lowered by the same amount, just enough
+        # to rank them below every chromosome that went further, in the order they had when dropped.
+        # With elite_scores (per seed, the worst elite's) a game stops once it can't beat
+        # them anymore even gaining cutoff_slack times the elite's points per piece
+        num_of_seeds = len(self.seeds)
+        final = self.racing_budgets[-1]
+        scores = np.zeros((len(population), num_of_seeds))
+        states = {}
+        finished = np.zeros((len(population), num_of_seeds), dtype=bool)
+        alive = np.arange(len(population))
+        reached = np.zeros(len(population), dtype=int)  # last budget played
+        chromos = population.tolist()
+        played_before = 0
+        for r, budget in enumerate(self.racing_budgets):
+            tasks = []
+            owners = []
+            for i in alive:
+                for s, seed in enumerate(self.seeds):
+                    if finished[i, s]:
+                        continue
+                    target = rate_cap = None
+                    if elite_scores is not None:
+                        target = elite_scores[s]
+                        rate_cap = self.cutoff_slack * max(target, 1) / final
+                    tasks.append((chromos[i], seed, states.get((i, s)), budget - played_before, target, rate_cap,
+                                  final - budget))
+                    owners.append((i, s))
+            for (i, s), (score, state, fin, played) in zip(owners, self.__map(play_race, tasks)):
+                scores[i, s] = score
+                states[i, s] = state
+                finished[i, s] = fin
+                self.pieces_played += played
+            if r < len(self.racing_budgets) - 1:
+                keep = max(1, int(np.ceil(len(alive) * self.keep_fraction)))
+                alive = alive[np.argsort(-scores[alive].mean(axis=1), kind='stable')[:keep]]
+                reached[alive] = r + 1
+            played_before = budget
+        for r in range(len(self.racing_budgets) - 2, -1, -1):
+            further = reached > r
+            dropped = reached == r
+            if further.any() and dropped.any():
+                floor = scores[further].mean(axis=1).min()
+                scores[dropped] -= max(0.0, scores[dropped].mean(axis=1).max() - floor + 1)
+        return scores
+
+    def __select(self, count):
+        # tournament selection, returns indices into the population
+        contenders = self.rng.integers(0, len(self.population), (count, self.tournament_size))
+        return contenders[np.arange(count), np.argmax(self.fitness[contenders], axis=1)]
+
+    def __breed(self, count):
+        mothers = self.population[self.__select(count)]
+        fathers = self.population[self.__select(count)]
+        # blend crossover: every gene is a random mix of both parents
+        mix = self.rng.random(mothers.shape)
+        crossed = self.rng.random(count) < self.crossover_rate
+        children = np.where(crossed[:, None], mix * mothers + (1 - mix) * fathers, mothers)
+        mutated = self.rng.random(children.shape) < self.mutation_rate
+        children += mutated * self.rng.normal(0, self.mutation_scale, children.shape)
+        return children
+
+    def step(self):
+        if self.fitness is None:
+            self.seed_scores = self.evaluate(self.population)
+            self.fitness = self.seed_scores.mean(axis=1)
+        order = np.argsort(-self.fitness, kind='stable')
+        elite = order[:self.elite_count]
+        children = self.__breed(len(self.population) - len(elite))
+        child_scores = self.evaluate(children, self.seed_scores[elite[-1]] if len(elite) else None)
+        # elites keep their scores, the game is deterministic for a seed
+        self.population = np.concatenate([self.population[elite], children])
+        self.seed_scores = np.concatenate([self.seed_scores[elite], child_scores])
+        self.fitness = self.seed_scores.mean(axis=1)
+        self.generation += 1
+        self.history.append((float(self.fitness.max()), float(self.fitness.mean())))
+        return self.best()
+
+    def best(self):
+        b = int(np.argmax(self.fitness))
+        return self.population[b].tolist(), float(self.fitness[b])
+
+    def emigrants(self, count):
+        # copies of the count best chromosomes and their seed scores, for another population
+        top = np.argsort(-self.fitness, kind='stable')[:count]
+        return self.population[top].copy(), self.seed_scores[top].copy()
+
+    def immigrate(self, population, seed_scores):
+        # chromosomes from another population take the places of the worst ones here. Their scores
+        # come along and stay valid as long as both populations play the same seeds and iters
+        count = min(len(population), len(self.population) - self.elite_count)
+        if count <= 0:
+            return
+        worst = np.argsort(self.fitness, kind='stable')[:count]
+        self.population[worst] = population[:count]
+        self.seed_scores[worst] = seed_scores[:count]
+        self.fitness = self.seed_scores.mean(axis=1)
+
+    def train(self, generations, verbose=True, checkpoint_path=None, checkpoint_every=1):
+        for _ in range(generations):
+            chromo, fit = self.step()
+            if verbose:
+                print('generation', self.generation, 'best', fit, chromo)
+            if checkpoint_path is not None and self.generation % checkpoint_every == 0:
+                self.save_checkpoint(checkpoint_path)
+        return self.best()
+
+    # region checkpoints
+    # a checkpoint is one uncompressed .npz (a few KB even for big populations), written aside and
+    # renamed over the old one so a crash mid write leaves the previous checkpoint intact
+    CHECKPOINT_VERSION = 1
+
+    def checkpoint_arrays(self):
+        # what goes in the .npz, subclasses add their own state
+        arrays = {'version': self.CHECKPOINT_VERSION, 'generation': self.generation,
+                  'pieces_played': self.pieces_played, 'population': self.population,
+                  'history': np.array(self.history, dtype=float).reshape(-1, 2),
+                  'config': json.dumps(self.config), 'rng_state': json.dumps(self.rng.bit_generator.state)}
+        if self.fitness is not None:
+            arrays['fitness'] = self.fitness
+            arrays['seed_scores'] = self.seed_scores
+        return arrays
+
+    def load_checkpoint_arrays(self, data):
+        self.population = data['population']
+        self.rng.bit_generator.state = json.loads(str(data['rng_state']))
+        self.generation = int(data['generation'])
+        self.pieces_played = int(data['pieces_played'])
+        self.history = [tuple(row) for row in data['history'].tolist()]
+        if 'fitness' in data:
+            self.fitness = data['fitness']
+            self.seed_scores = data['seed_scores']
+
+    def save_checkpoint(self, path):
+        arrays = self.checkpoint_arrays()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def resume(cls, path, **overrides):
+        # the trainer of a checkpoint, its next step() is the one the saved run would have done.
+        # overrides replace saved settings (processes.. not the ones that change the results)
+        with np.load(path) as data:
+            if int(data['version']) != cls.CHECKPOINT_VERSION:
+                raise ValueError('checkpoint version %d, expected %d' % (int(data['version']),
+                                                                         cls.CHECKPOINT_VERSION))
+            config = json.loads(str(data['config']))
+            config.update(overrides)
+            trainer = cls(population=data['population'], **config)
+            trainer.load_checkpoint_arrays(data)
+        return trainer
+
+    # endregion
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='train eternal_batch weights')
+    parser.add_argument('--generations', type=int, default=10)
+    parser.add_argument('--checkpoint', help='save the trainer here after every generation')
+    parser.add_argument('--resume', action='store_true', help='carry on from --checkpoint')
+    args = parser.parse_args()
+    if args.resume:
+        trainer = GeneticTrainer.resume(args.checkpoint)
+    else:
+        # start from the hand made chromosome plus random ones
+        trainer = GeneticTrainer('eternal_batch', population_size=40, num_of_iters=300, seeds=(17, 5132),
+                                 env_name='BitTetrisEnv', rng_seed=0)
+        trainer.population[0] = TetrisSIE.eternal_chromo
+    with trainer:
+        print(trainer.train(args.generations, checkpoint_path=args.checkpoint))
@@ -0,0 +1,149 @@
+import argparse
+import multiprocessing
+import queue
+import time
+import traceback
+
+import numpy as np
+
+from Genetic import GeneticTrainer
+
+# island model: every island is a process evolving its own GeneticTrainer (no pool, its games are
+# played in the island process), so selection never waits on the other islands. Every
+# migration_interval generations each island sends copies of its `migrants` best chromosomes
+# (with their seed scores, no replay needed) to its neighbours and takes the ones sent to it in
+# place of its worst. That is the only communication, a few chromosomes per interval.
+# Islands wait for their incoming migrants, so a run is the same for the same rng_seed however
+# the processes get scheduled. An island that raises sends its traceback instead of its results
+# and train() stops all of them, the others would wait for its migrants forever
+
+
+def topology(name, count):
+    # out neighbours of every island
+    if name == 'ring':
+        return [[(i + 1) % count] for i in range(count)] if count > 1 else [[]]
+    if name == 'ring2':  # both ways round the ring
+        return [sorted({(i - 1) % count, (i + 1) % count} - {i}) for i in range(count)]
+    if name == 'full':
+        return [[j for j in range(count) if j != i] for i in range(count)]
+    if name == 'none':  # independent runs
+        return [[] for _ in range(count)]
+    raise ValueError('unknown topology %r' % name)
+
+
+def run_island(index, trainer_args, generations, interval, migrants, neighbours, inboxes, results):
+    try:
+        play_island(index, trainer_args, generations, interval, migrants, neighbours, inboxes, results)
+    except Exception:
+        results.put((index, 'error', traceback.format_exc()))
+
+
+def play_island(index, trainer_args, generations, interval, migrants, neighbours, inboxes, results):
+    sources = {i for i, outs in enumerate(neighbours) if index in outs}
+    early = {}  # (generation, source) -> migrants that came before this island got there
+    with GeneticTrainer(processes=1, **trainer_args) as trainer:
+        start = time.perf_counter()
+        for _ in range(generations):
+            trainer.step()
+            if trainer.generation % interval or trainer.generation == generations:
+                continue
+            sent = trainer.emigrants(migrants)
+            for j in neighbours[index]:
+                inboxes[j].put((trainer.generation, index, sent))
+            while any((trainer.generation, s) not in early for s in sources):
+                generation, source, arrived = inboxes[index].get()
+                early[generation, source] = arrived
+            # in source order, not arrival order
+            for s in sorted(sources):
+                trainer.immigrate(*early.pop((trainer.generation, s)))
+        results.put((index, 'done', (trainer.population, trainer.seed_scores, trainer.history, trainer.pieces_played,
+                                     time.perf_counter() - start)))
+
+
+class IslandModel:
+    # num_of_islands GeneticTrainers of population_size each, trainer_args go to every one of
+    # them (all islands must play the same seeds and num_of_iters for migrant scores to hold)
+    def __init__(self, num_of_islands=4, topology_name='ring', migration_interval=5, migrants=2, rng_seed=None,
+                 population=None, **trainer_args):
+        self.neighbours = topology(topology_name, num_of_islands) if isinstance(topology_name, str) \
+            else [list(outs) for outs in topology_name]
+        if len(self.neighbours) != num_of_islands:
+            raise ValueError('topology has %d islands, expected %d' % (len(self.neighbours), num_of_islands))
+        self.num_of_islands = num_of_islands
+        self.migration_interval = migration_interval
+        self.migrants = migrants
+        self.trainer_args = trainer_args
+        self.island_seeds = np.random.SeedSequence(rng_seed).generate_state(num_of_islands).tolist()
+        # initial populations of the islands, None for random ones
+        self.initial = list(population) if population is not None else [None] * num_of_islands
+        self.populations = None
+        self.seed_scores = None
+        self.histories = None
+        self.pieces_played = 0
+        self.seconds = None  # wall time of every island
+
+    def train(self, generations):
+        ctx = multiprocessing.get_context()
+        inboxes = [ctx.Queue() for _ in range(self.num_of_islands)]
+        results = ctx.Queue()
+        islands = [ctx.Process(target=run_island,
+                               args=(i, dict(self.trainer_args, rng_seed=self.island_seeds[i],
+                                             population=self.initial[i]),
+                                     generations, self.migration_interval, self.migrants, self.neighbours,
+                                     inboxes, results))
+                   for i in range(self.num_of_islands)]
+        for p in islands:
+            p.start()
+        finished = [None] * self.num_of_islands
+        try:
+            while None in finished:
+                try:
+                    index, status, result = results.get(timeout=1.0)
+                except queue.Empty:
+                    # killed without a word (exit code 0 is one whose results are still on the way)
+                    lost = [i for i, p in enumerate(islands) if p.exitcode and finished[i] is None]
+                    if lost:
+                        raise RuntimeError('island %d died with exit code %d' % (lost[0], islands[lost[0]].exitcode))
+                    continue
+                if status == 'error':
+                    raise RuntimeError('island %d failed:\n%s' % (index, result))
+                finished[index] = result
+        except BaseException:
+            for p in islands:
+                p.terminate()
+            raise
+        finally:
+            for p in islands:
+                p.join()
+        self.populations = [f[0] for f in finished]
+        self.seed_scores = [f[1] for f in finished]
+        self.histories = [f[2] for f in finished]
+        self.pieces_played += sum(f[3] for f in finished)
+        self.seconds = [f[4] for f in finished]
+        # the next train() carries on from where the islands are now
+        self.initial = self.populations
+        return self.best()
+
+    def best(self):
+        fitness = [s.mean(axis=1) for s in self.seed_scores]
+        i = max(range(self.num_of_islands), key=lambda k: fitness[k].max())
+        b = int(np.argmax(fitness[i]))
+        return self.populations[i][b].tolist(), float(fitness[i][b])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='island model training of eternal_batch weights')
+    parser.add_argument('--islands', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--topology', default='ring', choices=('ring', 'ring2', 'full', 'none'))
+    parser.add_argument('--interval', type=int, default=5, help='generations between migrations')
+    parser.add_argument('--migrants', type=int, default=2, help='chromosomes each island sends')
+    parser.add_argument('--generations', type=int, default=10)
+    parser.add_argument('--population', type=int, default=20, help='population of every island')
+    args = parser.parse_args()
+    model = IslandModel(args.islands, args.topology, args.interval, args.migrants, rng_seed=0,
+                        scoring_name='eternal_batch', population_size=args.population, num_of_iters=300,
+                        seeds=(17, 5132), env_name='BitTetrisEnv')
+    start = time.perf_counter()
+    print(model.train(args.generations))
+    elapsed = time.perf_counter() - start
+    print('%d pieces in %.1f s, %.0f pieces/s' % (model.pieces_played, elapsed, model.pieces_played / elapsed))
@@ -0,0 +1,148 @@
+import numpy as np
+
+import TetrisSIE
+from TetrisSIE import TetrisEnv, BitTetrisEnv, COLUMN_FEATURES, batch_features
+from VecTetris import MAX_PLACEMENTS
+
+
+# decision points (board, piece, next piece) of recorded games with the features of every
+# placement there already computed, so a linear chromosome is scored on all of them with one
+# (P x F) @ (F x placements) product instead of playing games. Placements are padded to
+# MAX_PLACEMENTS per point: features (D, M, F) (0 for column features and game overs), scores and
+# game_over (D, M), index (D, cols, 4) run's (col, rot) to placement, expert (D,) the placement
+# the recorded game played. Moves are picked on the (col, rot) grid like run, ties included
+class DecisionSet:
+    def __init__(self, feature_names, features, scores, game_over, index, expert, pieces, next_pieces):
+        self.feature_names = tuple(feature_names)
+        self.features = features
+        self.scores = scores
+        self.game_over = game_over
+        self.index = index
+        self.expert = expert
+        self.pieces = pieces
+        self.next_pieces = next_pieces
+        self.__grid_cache = None
+
+    def __len__(self):
+        return len(self.expert)
+
+    @classmethod
+    def record(cls, scoring_function, genetic_params, seeds, num_of_iters, feature_names=None,
+               env_class=BitTetrisEnv):
+        # one game per seed through run(return_trace=True), every move but the last of a game
+        # (its next piece is not in the trace) is a decision point
+        feature_names = tuple(feature_names or scoring_function.features)
+        env = env_class()
+        points = []
+        for seed in seeds:
+            env.set_seed(seed)
+            _, boards, _, pieces, _ = env.run(scoring_function, genetic_params, num_of_iters, True)
+            trace = boards.trace
+            board = np.zeros(TetrisEnv.TETRIS_GRID, dtype=np.byte)
+            for i, after in enumerate(boards):
+                if i + 1 < len(pieces):
+                    points.append((board, pieces[i], pieces[i + 1], int(trace.cols[i]), int(trace.rots[i])))
+                board = after
+        return cls.from_points(points, feature_names)
+
+    @classmethod
+    def from_points(cls, points, feature_names):
+        # points are (board, piece, next_piece, played col, played rot)
+        d = len(points)
+        f = len(feature_names)
+        features = np.zeros((d, MAX_PLACEMENTS, f))
+        scores = np.zeros((d, MAX_PLACEMENTS))
+        game_over = np.zeros((d, MAX_PLACEMENTS), dtype=bool)
+        index = np.zeros((d, TetrisEnv.MAX_TETRIS_COLS, 4), dtype=np.intp)
+        expert = np.zeros(d, dtype=np.intp)
+        board_f = [i for i, name in enumerate(feature_names) if name not in COLUMN_FEATURES]
+        env = TetrisEnv()
+        for p, (board, piece, _, col, rot) in enumerate(points):
+            placements = env.enumerate_placements(board, piece)
+            m = len(placements.scores)
+            scores[p, :m] = placements.scores
+            game_over[p, :m] = placements.game_over
+            index[p] = placements.index
+            alive = np.flatnonzero(~placements.game_over)
+            if board_f and len(alive):
+                features[p, alive[:, None], board_f] = batch_features(placements.boards[alive],
+                                                                      [feature_names[i] for i in board_f],
+                                                                      placements.gameover_rows)
+            expert[p] = placements.index[col, rot]
+        pieces = np.array([TetrisEnv.TETRIS_PIECES.index(point[1]) for point in points], dtype=np.uint8)
+        next_pieces = np.array([TetrisEnv.TETRIS_PIECES.index(point[2]) for point in points], dtype=np.uint8)
+        return cls(feature_names, features, scores, game_over, index, expert, pieces, next_pieces)
+
+    def save(self, path):
+        np.savez(path, feature_names=np.array(self.feature_names), features=self.features, scores=self.scores,
+                 game_over=self.game_over, index=self.index, expert=self.expert, pieces=self.pieces,
+                 next_pieces=self.next_pieces)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['feature_names'].tolist(), data['features'], data['scores'], data['game_over'],
+                       data['index'], data['expert'], data['pieces'], data['next_pieces'])
+
+    def __grid(self):
+        # features and scores on run's (col, rot) grid, column features in place (not for game
+        # overs), so rating every move of every point is just the product
+        if self.__grid_cache is None:
+            d = len(self)
+            flat_index = self.index.reshape(d, -1)
+            points = np.arange(d)[:, None]
+            features = self.features[points, flat_index]
+            alive = ~self.game_over[points, flat_index]
+            asked_cols = np.repeat(np.arange(TetrisEnv.MAX_TETRIS_COLS), 4)
+            for i, name in enumerate(self.feature_names):
+                if name in COLUMN_FEATURES:
+                    features[:, :, i] = np.where(alive, COLUMN_FEATURES[name](asked_cols), 0)
+            self.__grid_cache = features.reshape(-1, features.shape[2]).T.copy(), self.scores[points, flat_index]
+        return self.__grid_cache
+
+    def choices(self, population):
+        # (P, D) placement every chromosome picks at every point, the one a linear_scoring run
+        # picks: first best column, first best rotation in it. A shorter chromosome uses the
+        # first features, as in linear_scoring
+        population = np.atleast_2d(np.asarray(population, dtype=float))
+        weights = np.zeros((len(population), len(self.feature_names)))
+        weights[:, :population.shape[1]] = population
+        features, scores = self.__grid()
+        d = len(self)
+        grid = (weights @ features).reshape(len(population), d, -1) + scores
+        return self.index.reshape(d, -1)[np.arange(d), np.argmax(grid, axis=2)]
+
+    def evaluate(self, population, chunk=256):
+        # per chromosome (agreement with the recorded moves, mean score of its moves, how often
+        # its move loses the game), chunk chromosomes at a time to bound the (chunk, D, cols * 4) ratings
+        population = np.atleast_2d(np.asarray(population, dtype=float))
+        agreement = np.zeros(len(population))
+        mean_score = np.zeros(len(population))
+        losing = np.zeros(len(population))
+        points = np.arange(len(self))
+        for start in range(0, len(population), chunk):
+            picked = self.choices(population[start:start + chunk])
+            end = start + len(picked)
+            agreement[start:end] = np.mean(picked == self.expert, axis=1)
+            mean_score[start:end] = np.mean(self.scores[points, picked], axis=1)
+            losing[start:end] = np.mean(self.game_over[points, picked], axis=1)
+        return agreement, mean_score, losing
+
+    def screen(self, population, keep):
+        # indices of the keep chromosomes worth real games: the most agreeing ones, fewer losing
+        # moves and a higher mean score breaking ties
+        agreement, mean_score, losing = self.evaluate(population)
+        order = np.lexsort((-mean_score, losing, -agreement))
+        return order[:keep]
+
+
+if __name__ == "__main__":
+    import time
+
+    data = DecisionSet.record(TetrisSIE.eternal_batch, TetrisSIE.eternal_chromo, (17, 5132, 4), 600)
+    candidates = np.random.default_rng(0).normal(TetrisSIE.eternal_chromo, 2.0, (5000, 5))
+    start = time.perf_counter()
+    best = data.screen(candidates, 10)
+    print(len(data), 'decision points,', len(candidates) / (time.perf_counter() - start), 'chromosomes/s')
+    print(data.evaluate(TetrisSIE.eternal_chromo))
+    print(candidates[best])
@@ -1,6 +1,9 @@
+import os
 import random
+import time
 
 import numpy as np
+from collections import defaultdict, namedtuple, OrderedDict
 from random import Random
 
 
@@ -37,6 +40,7 @@ class TetrisEnv:
     TOTAL_ROWS = MAX_TETRIS_ROWS + GAMEOVER_ROWS
     MAX_TETRIS_COLS = 10
     GAMEOVER_PENALTY = -1000
+    LINE_SCORES = (0, SCORE_SINGLE, SCORE_DOUBLE, SCORE_TRIPLE, SCORE_TETRIS)
     TETRIS_GRID = (TOTAL_ROWS, MAX_TETRIS_COLS)
     TETRIS_PIECES = ['O', 'I', 'S', 'Z', 'T', 'L', 'J']
     # Note, pieces are rotated clockwise
@@ -61,25 +65,76 @@ class TetrisEnv:
      last one is utf
     '''
 
-    def __init__(self):
+    # rows (without the game over ones), cols and gameover_rows of this env's board, the class
+    # constants by default. Everything geometric is read from self, so one env can be 44x20
+    def __init__(self, rows=None, cols=None, gameover_rows=None):
+        self.MAX_TETRIS_ROWS = rows or TetrisEnv.MAX_TETRIS_ROWS
+        self.GAMEOVER_ROWS = gameover_rows or TetrisEnv.GAMEOVER_ROWS
+        self.TOTAL_ROWS = self.MAX_TETRIS_ROWS + self.GAMEOVER_ROWS
+        self.MAX_TETRIS_COLS = cols or TetrisEnv.MAX_TETRIS_COLS
+        self.TETRIS_GRID = (self.TOTAL_ROWS, self.MAX_TETRIS_COLS)
         self.RNG = Random()  # independent RNG
         self.default_seed = 17  # default seed is IT
+        self.play_cache = PlayCache()  # afterstates for lookahead, kept across moves and games
+        self.stats = None  # a RunStats while profiling, see run(..., profile=True)
+        self.piece_source = None  # a PieceSequences to read the pieces from instead of drawing them
         self.__restart()
 
     def __restart(self):
         self.RNG.seed(self.default_seed)
-        self.board = np.zeros(self.TETRIS_GRID, dtype=np.byte)
-        self.current_piece = self.RNG.choice(self.TETRIS_PIECES)
-        self.next_piece = self.RNG.choice(self.TETRIS_PIECES)
+        self.board = self.empty_board()
+        self.summary = BoardSummary.from_board(self.board, self.MAX_TETRIS_COLS, self.GAMEOVER_ROWS)
+        self.pieces_drawn = 0
+        self.sequence = None
+        if self.piece_source is not None:
+            self.sequence = self.piece_source.get(self.default_seed, self.piece_source.min_length)
+        self.current_piece = self.__draw_piece()
+        self.next_piece = self.__draw_piece()
         self.score = 0
 
+    def __draw_piece(self):
+        # same pieces either way, the sequences are made with this exact RNG.choice stream
+        if self.sequence is None:
+            piece = self.RNG.choice(self.TETRIS_PIECES)
+        else:
+            if self.pieces_drawn >= len(self.sequence):
+                self.sequence = self.piece_source.get(self.default_seed, self.pieces_drawn + 1)
+            piece = self.TETRIS_PIECES[self.sequence[self.pieces_drawn]]
+        self.pieces_drawn += 1
+        return piece
+
     def __gen_next_piece(self):
         self.current_piece = self.next_piece
-        self.next_piece = self.RNG.choice(self.TETRIS_PIECES)
+        self.next_piece = self.__draw_piece()
 
     def set_seed(self, seed_value):
         self.default_seed = seed_value
 
+    # a game can be stopped and carried on later (even in another process) with the same pieces:
+    # the RNG is not kept, it is reseeded and moved past the pieces already drawn
+    def get_state(self):
+        return GameState(self.default_seed, self.board.copy(), self.current_piece, self.next_piece, self.score,
+                         self.pieces_drawn)
+
+    def set_state(self, state):
+        self.default_seed = state.seed
+        self.RNG.seed(state.seed)
+        if self.piece_source is not None:
+            self.sequence = self.piece_source.get(state.seed, state.pieces_drawn + 1)
+        else:
+            self.sequence = None
+            for _ in range(state.pieces_drawn):
+                self.RNG.choice(self.TETRIS_PIECES)
+        self.board = state.board.copy()
+        self.summary = BoardSummary.from_board(self.board, self.MAX_TETRIS_COLS, self.GAMEOVER_ROWS)
+        self.current_piece = state.current_piece
+        self.next_piece = state.next_piece
+        self.score = state.score
+        self.pieces_drawn = state.pieces_drawn
+
+    def empty_board(self):
+        return np.zeros(self.TETRIS_GRID, dtype=np.byte)
+
     def get_status(self):
         return self.board.copy(), self.current_piece, self.next_piece
 
@@ -98,139 +153,776 @@ class TetrisEnv:
         return 0
 
     def __collapse_rows(self, board):
-        start_collapse = -1
-        for row, i in zip(board, range(TetrisEnv.TOTAL_ROWS)):
-            if np.sum(row) == TetrisEnv.MAX_TETRIS_COLS:
-                start_collapse = i
-                break
-        if start_collapse == -1:
+        if self.stats is not None:
+            collapse_score, board = self.stats.timed('collapse', self.__clear_full_rows, board)
+            self.stats.collapses += collapse_score > 0
+            return collapse_score, board
+        return self.__clear_full_rows(board)
+
+    def __clear_full_rows(self, board):
+        # every full row goes in one pass, not only the first block of them
+        full = np.sum(board, axis=1) == self.MAX_TETRIS_COLS
+        cleared = np.count_nonzero(full)
+        if cleared == 0:
             return 0, board
-        end_collapse = start_collapse + 1
-        while end_collapse < TetrisEnv.TOTAL_ROWS:
-            if np.sum(board[end_collapse]) == TetrisEnv.MAX_TETRIS_COLS:
-                end_collapse += 1
-            else:
-                break
-        new_board = np.delete(board, slice(start_collapse, end_collapse), axis=0)  # now we need to add them
-        new_board = np.insert(new_board, slice(0, end_collapse - start_collapse), 0, axis=0)
-        score = self.__get_score(end_collapse - start_collapse)
-
-        return score, new_board
+        new_board = np.zeros_like(board)
+        new_board[cleared:] = board[~full]
+        return self.__get_score(cleared), new_board
 
     def __game_over(self, test_board):
-        return np.sum(test_board[:TetrisEnv.GAMEOVER_ROWS]) > 0
+        if self.stats is not None:
+            return self.stats.timed('game_over', self.__top_rows_used, test_board)
+        return self.__top_rows_used(test_board)
+
+    def __top_rows_used(self, test_board):
+        return np.sum(test_board[:self.GAMEOVER_ROWS]) > 0
 
     def __play(self, col, rot_count):
-        falling_piece = self.Pieces[self.current_piece]
-        if rot_count > 0:
-            falling_piece = np.rot90(falling_piece, rot_count, axes=(1, 0))
-        p_dims = falling_piece.shape
-        col = min(col, TetrisEnv.MAX_TETRIS_COLS - p_dims[1])
-        max_row = TetrisEnv.TOTAL_ROWS - p_dims[0]
-        chosen_row = 0
-        while chosen_row < max_row:
-            next_row = chosen_row + 1
-            if np.sum(np.multiply(falling_piece,
-                                  self.board[next_row:next_row + p_dims[0], col:col + p_dims[1]])) > 0:
-                break
-            chosen_row = next_row
-        self.board[chosen_row:chosen_row + p_dims[0], col:col + p_dims[1]] |= falling_piece
-        collapse_score, new_board = self.__collapse_rows(self.board)
-        collapse_score += np.sum(falling_piece) * TetrisEnv.SCORE_PIXEL
-        if self.__game_over(new_board):
-            return TetrisEnv.GAMEOVER_PENALTY
-        self.board = new_board
-        return collapse_score
+        # a copy, TetrisEnv.test_play stamps the piece on the board it is given
+        play_score, board = self.test_play(self.board.copy(), self.current_piece, col, rot_count, self.summary)
+        if play_score == TetrisEnv.GAMEOVER_PENALTY:
+            # a losing move leaves the board as it always did: the piece stamped on, no rows cleared
+            self.board = self.place_piece(self.board, self.current_piece, col, rot_count)
+            self.summary = BoardSummary.from_board(self.board, self.MAX_TETRIS_COLS, self.GAMEOVER_ROWS)
+        else:
+            self.board = board
+        return play_score
+
+    # board (not changed) with the piece where it lands, full rows left in
+    def place_piece(self, board, piece_type, col, rot_count):
+        form = PIECE_TABLE[piece_type][rot_count % 4]
+        col = min(col, self.MAX_TETRIS_COLS - form.width)
+        board = board.copy()
+        row = landing_row(column_tops(board[:, col:col + form.width]).tolist(), form)
+        board[row:row + form.height, col:col + form.width] |= form.shape
+        return board
 
     # does not affect the class, tests a play of the game given a board and a piece b64 #
-    def test_play(self, board_copy, piece_type, col, rot_count):
-        falling_piece = self.Pieces[piece_type]
-        if rot_count > 0:
-            falling_piece = np.rot90(falling_piece, rot_count, axes=(1, 0))
-        p_dims = falling_piece.shape
-        col = min(col, TetrisEnv.MAX_TETRIS_COLS - p_dims[1])
-        max_row = TetrisEnv.TOTAL_ROWS - p_dims[0]
-        chosen_row = 0
-        while chosen_row < max_row:
-            next_row = chosen_row + 1
-            if np.sum(np.multiply(falling_piece,
-                                  board_copy[next_row:next_row + p_dims[0], col:col + p_dims[1]])) > 0:
-                break
-            chosen_row = next_row
-        board_copy[chosen_row:chosen_row + p_dims[0], col:col + p_dims[1]] |= falling_piece
+    # summary (BoardSummary of board_copy) is played along in place when given
+    def test_play(self, board_copy, piece_type, col, rot_count, summary=None):
+        if summary is not None:
+            summary.play(piece_type, col, rot_count)
+        if self.stats is not None:
+            return self.stats.timed('test_play', self.__test_play, board_copy, piece_type, col, rot_count)
+        return self.__test_play(board_copy, piece_type, col, rot_count)
+
+    def __test_play(self, board_copy, piece_type, col, rot_count):
+        form = PIECE_TABLE[piece_type][rot_count % 4]
+        col = min(col, self.MAX_TETRIS_COLS - form.width)
+        chosen_row = landing_row(column_tops(board_copy[:, col:col + form.width]).tolist(), form)
+        board_copy[chosen_row:chosen_row + form.height, col:col + form.width] |= form.shape
         collapse_score, board_copy = self.__collapse_rows(board_copy)
-        collapse_score += np.sum(falling_piece) * TetrisEnv.SCORE_PIXEL
+        collapse_score += form.pixels * TetrisEnv.SCORE_PIXEL
         if self.__game_over(board_copy):
             return TetrisEnv.GAMEOVER_PENALTY, board_copy
         return collapse_score, board_copy
 
+    # every distinct (col, rot) placement of piece on board in one batch, see Placements
+    def enumerate_placements(self, board, piece_type):
+        tops = column_tops(board).tolist()
+        distinct = PIECE_ROTATIONS[piece_type]
+        cols, rots, landing = [], [], []
+        cell_n, cell_r, cell_c = [], [], []
+        first_of_rot = {}
+        for rot in distinct:
+            form = PIECE_TABLE[piece_type][rot]
+            first_of_rot[rot] = len(cols)
+            for col in range(self.MAX_TETRIS_COLS - form.width + 1):
+                row = landing_row(tops, form, col)
+                cell_n.extend([len(cols)] * form.pixels)
+                cell_r.extend(row + r for r in form.cells[0])
+                cell_c.extend(col + c for c in form.cells[1])
+                cols.append(col)
+                rots.append(rot)
+                landing.append(row)
+        # what run asks for: column c with rotation r is the clamped col of the same shape
+        index = np.empty((self.MAX_TETRIS_COLS, 4), dtype=np.intp)
+        for rot in range(4):
+            form = PIECE_TABLE[piece_type][rot]
+            for col in range(self.MAX_TETRIS_COLS):
+                index[col, rot] = first_of_rot[rot % len(distinct)] + \
+                    min(col, self.MAX_TETRIS_COLS - form.width)
+
+        boards = np.repeat(board[None], len(cols), axis=0)
+        boards[cell_n, cell_r, cell_c] = 1
+        boards, cleared = collapse_stack(boards)
+        game_over = np.any(boards[:, :self.GAMEOVER_ROWS], axis=(1, 2))
+        scores = np.asarray(TetrisEnv.LINE_SCORES)[cleared] + \
+            PIECE_TABLE[piece_type][0].pixels * TetrisEnv.SCORE_PIXEL
+        scores[game_over] = TetrisEnv.GAMEOVER_PENALTY
+        return Placements(boards, scores, game_over, np.array(cols), np.array(rots), np.array(landing),
+                          index, self.GAMEOVER_ROWS)
+
     def __calc_rank_n_rot(self, scoring_function, genetic_params, col):
         # should return rank score and rotation a pair (rank,rot), rot is from 0 to 3
         return scoring_function(self, genetic_params, col)
 
+    def __rate_columns(self, scoring_function, genetic_params):
+        # per column (rates, rotations), one call per column or one batched call for all of them
+        if getattr(scoring_function, 'batched', False):
+            board, piece, _ = self.get_status()
+            if self.stats is not None:
+                placements = self.stats.timed('enumerate_placements', self.enumerate_placements, board, piece)
+            else:
+                placements = self.enumerate_placements(board, piece)
+            grid = scoring_function(self, genetic_params, placements)
+            return np.max(grid, axis=1).tolist(), np.argmax(grid, axis=1).tolist()
+        rates = []
+        rotations = []
+        for c in range(self.MAX_TETRIS_COLS):
+            r1, r2 = self.__calc_rank_n_rot(scoring_function, genetic_params, c)
+            rates.append(r1)
+            rotations.append(r2)
+        return rates, rotations
+
     def __get_lose_msg(self):
         # if understood, send to owner
         lose_msg = b'TFVMISBfIFlPVSBMT1NFIQrilZbilKTilKTilLzilZHilaLilaLilaLilaLilaLilaLilaPilaLilaLilaPilaLilaLilaLilazilazilazilazilazilazilaPilaPilaLilaLilaLilaLilaLilaLilaPilaLilazilazilazilazilazilaPilaPilaPilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaIK4pSk4pWc4pWc4pSC4pSU4pSU4pWZ4pWZ4pWc4pWc4pWc4pWZ4pWZ4pWZ4pWZ4pWc4pWc4pWi4pWi4pWi4pWi4pWr4pWs4pWj4pWj4pWj4pWj4pWi4pWi4pWi4pWi4pWi4pWc4pWc4pWc4pWc4pWc4pWc4pWc4pWi4pWj4pWj4pWc4pWc4pWc4pWc4pWc4pSk4pSC4pSC4pSC4pSC4pWc4pWc4pWc4pWR4pWc4pWR4pWi4pWiCuKVnOKUguKUlCAgICAgICAgICAgIOKUguKUguKUguKVkeKVouKVouKVouKVouKVouKVouKVo+KVouKVouKVouKVouKVnOKVnOKUguKUguKUguKUguKUlCAgIOKUlOKUlOKUlOKUlOKUlCDilJTilZnilKTilKTilKTilKTilZzilZzilZzilZzilZzilZzilZzilZwK4pSC4pSU4pSM4pSM4pSM4pWT4pWT4pWT4pWT4pWT4pWT4pWT4pWT4pWTICAg4pSU4pWZ4pWi4pWi4pWi4pWR4pWi4pWi4pWj4pWs4pWi4pWR4pWc4pSC4pSC4pSC4pSC4pSUICAgICAgICDilZPilZbilZbilZbilZbilZbilZbilKTilKTilKTilKTilKTilKTilZzilKTilKTilZwK4pSC4pSC4pWT4pWR4pWi4pWi4pWi4pWi4pWj4pWj4pWj4pWi4pWi4pWi4pWj4pWj4pWW4pWW4pSM4pSU4pWZ4pWc4pWc4pWZ4pWi4pWi4pWj4pWi4pWi4pWi4pSk4pSC4pSC4pSC4pWW4pWW4pWW4pWW4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWj4pWj4pWj4pWi4pWi4pWi4pWi4pSk4pWc4pSk4pWc4pWc4pWc4pWcCuKUguKUlCAgICAgICAg4pSU4pWZ4pWc4pWc4pSC4pWZ4pWc4pWc4pWi4pWW4pWW4pWW4pWW4pWW4pWi4pWr4pWs4pWj4pWi4pWi4pWi4pWi4pWW4pSk4pSC4pSC4pWc4pWc4pWc4pWc4pWc4pWc4pWc4pWc4pWZ4pWZ4pWZ4pWZ4pWZ4pWc4pWc4pWc4pWc4pWc4pWi4pWi4pWR4pSk4pSk4pSkCuKVluKUkCAgIOKVk+KVk+KVluKVluKVluKVluKVluKVluKVluKVouKVouKVouKVouKVouKVouKVouKVouKVouKVouKVouKVouKVo+KVo+KVo+KVouKVouKVouKVouKVouKVluKVouKVouKUpOKUguKUguKUlCAgICAg4pSM4pSMICAgICAg4pSM4pSC4pSC4pSC4pWc4pWcCuKVouKVluKVnOKUpOKUguKUguKUguKVnOKVnOKVnOKVnOKVouKVouKVouKVnOKVouKVouKVouKVouKVouKVouKVouKVouKVouKVouKVouKVo+KVouKVouKVouKVouKVouKVouKVouKVouKVouKVouKVouKVluKUpOKUvOKVouKVouKVrOKVrOKVrOKVo+KVo+KVouKVouKVouKVouKVo+KVouKVouKVluKVluKVluKVouKVogrilaLilaLilZbilZbilZbilZbilILilILilIzilZPilZbilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaPilaPilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilZbilILilILilILilZnilZnilZnilZzilZzilaLilaLilaLilaLilaLilaLilaLilaLilaLilaIK4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWj4pWj4pWi4pWi4pWi4pWi4pWi4pWc4pWc4pWc4pWc4pWR4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWj4pWi4pWi4pWi4pWi4pWi4pWi4pWj4pWi4pWi4pWi4pWi4pWi4pWj4pWi4pWi4pWi4pWi4pWi4pWiCuKVnOKVouKVouKVouKVouKVouKVouKVouKVo+KVo+KVouKVouKVouKVouKVouKVouKVnOKVnOKVnOKVnOKVluKVouKVouKVouKVouKVouKVouKVouKVouKVnOKVnOKVnOKVouKVouKVouKVnOKVnOKVq+KVrOKVrOKVrOKVo+KVouKVouKVouKVouKVouKVouKVouKVrOKVrOKVrOKVrOKVo+KVo+KVouKVouKVouKVouKVogrilZHilaLilaLilaLilaLilaLilaLilaLilaPilaPilaLilaLilaLilZzilZzilaLilZHilKTilILilZHilaLilaLilaLilaLilaPilaLilKTilKTilKTilILilILilZbilZHilaLilaLilZbilZbilKTilZzilZzilavilazilazilazilazilazilazilazilazilazilazilazilaPilaPilaPilaLilaPilaLilaLilaIK4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWc4pSC4pSC4pWR4pWc4pWc4pWc4pWc4pWc4pWi4pWi4pWc4pWc4pWc4pWc4pWc4pWc4pSk4pWW4pWR4pWi4pWi4pWi4pWi4pWc4pWc4pWZ4pWi4pWi4pWW4pWZ4pWZ4pWi4pWr4pWs4pWs4pWs4pWs4pWs4pWj4pWj4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWiCuKVnOKVnOKVnOKVnOKVouKVouKVouKVouKVouKVnOKVnOKUguKVluKVouKVnOKVnOKVmeKVmeKVnOKUpOKUpOKUpOKUguKUguKUguKUguKVnOKVnOKVnOKVnOKVnOKVqOKVqOKVnOKVnOKVnOKUguKUguKVkeKVouKVo+KVouKUpOKVnOKVnOKVnOKVnOKVnOKVnOKVouKVouKVouKVouKVouKVouKVouKVouKVouKVouKVogrilILilILilILilILilZzilZzilaLilZzilZzilILilILilZPilZzilJggICAgICAgIOKUlOKUlOKUlCAgICAgICAgIOKUjCAg4pSC4pWc4pSC4pSC4pSC4pWc4pSk4pSk4pWc4pWc4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWc4pWi4pWi4pWR4pWcCuKUguKUguKUguKUguKUguKUguKUguKUguKUguKUguKUguKUmCAgICAgICAgICAg4pSM4pWT4pWT4pSQICDilJTilJTilJTilJTilJQgIOKUlOKUguKUguKUlOKUlOKUlOKUlOKUguKUguKUguKUguKUguKUguKVnOKVnOKVnOKVnOKVnOKVnOKVnOKVnOKVnOKVnOKUggrilILilILilILilILilILilILilILilILilILilILilJQgICAgICAgICAgICAg4pSC4pSCICAgICDilIwgICAgIOKUguKUgiAgICAg4pSU4pSC4pSC4pSC4pSC4pSC4pSC4pWc4pWc4pWc4pWc4pSk4pSk4pSC4pSC4pSCCuKUguKUguKUguKUguKUguKUguKUguKUguKUgiAgICAgICAgICAgICAg4pSM4pWT4pWW4pSQICAgIOKUguKUgiAgICAg4pSUICAgICAgICAg4pSU4pSC4pSC4pSC4pSC4pSC4pSk4pSk4pSC4pSC4pSC4pSkCuKUguKUguKUguKUguKUguKUguKUguKUpOKUmCAgICAgICAgICAgICDilJTilZnilZzilZzilZzilKTilJAg4pSM4pSC4pSM4pSMICAg4pSM4pSM4pSQ4pSMICAgICAgICAg4pWZ4pWc4pSC4pSC4pSC4pSk4pSk4pSk4pSk4pSkCuKUguKUguKUguKUguKUguKUguKUguKUpOKUkCAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICDilJTilJTilJjilJAgICAgIOKUlOKVnOKVnOKVnOKUpOKUpOKUpOKUpArilILilILilILilILilILilILilILilZHilZbilZbilJDilZPilILilIIgICDilJTilavilazilazilaPilIAgICAgICAgICAgICAgICAgICAgICAgICAg4pSU4pWW4pWW4pWW4pSC4pSC4pWW4pSk4pSk4pWc4pSk4pSCCuKUguKUguKUguKUguKUguKUguKUguKVnOKVnOKVouKVo+KUpOKUguKUguKVkeKVouKVliAgICAgICDilZPilZPilZMgICAgICAgIOKVk+KVk+KVk+KVluKVluKVluKVluKVluKVluKVluKUkCAg4pWT4pWW4pSC4pSC4pSC4pSC4pWR4pWc4pWc4pSk4pSC4pSCCuKUguKUguKUguKUguKUguKUguKUguKUguKUguKVmeKVouKUpOKUguKUguKVmeKVouKVouKUpOKVluKVluKVpeKVpeKVo+KVo+KVouKVouKVouKVrOKVrOKVrOKVrOKVrOKVrOKVrOKVo+KVo+KVo+KVouKVouKVouKVnOKVnOKVnOKVnOKUguKUguKVk+KVkeKVouKVnOKUguKUguKUguKUguKVnOKVnOKUpOKUguKUguKUggrilILilILilILilILilILilILilILilILilILilZzilZzilKTilKTilZbilILilZHilaLilKTilILilILilZnilaLilaLilaPilaPilaPilaLilaPilaLilaLilaLilaLilaLilaLilaLilaLilaLilaLilaPilaLilZzilKTilILilILilZbilaLilaPilZzilZzilKTilILilILilILilKTilZzilKTilKTilILilILilIIK4pSC4pSC4pSC4pSC4pSC4pSC4pSC4pWR4pWW4pSC4pSC4pSk4pSk4pSk4pSk4pSk4pWR4pSk4pSC4pSC4pSC4pSC4pWR4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWi4pWj4pWi4pWc4pWc4pWc4pWc4pWc4pSC4pSC4pSC4pWT4pWc4pWi4pWi4pWi4pWi4pWi4pWi4pSk4pSk4pSk4pSk4pWc4pWc4pSk4pSC4pSC4pSC4pSCCuKUguKUguKUguKUguKUguKUguKUguKVkeKVouKVluKUguKVmeKVkeKUpOKUpOKVnOKVnOKVnOKUpOKUguKUguKUguKUpOKVnOKUpOKUpOKVnOKVnOKVnOKVnOKVnOKVnOKUguKVk+KVk+KVq+KVrOKVrOKVmeKVnOKVnOKVnOKVnOKVkeKVouKVouKVouKVouKVouKVnOKUpOKUpOKUpOKVnOKUpOKUpOKUpOKUguKUguKUggrilILilILilILilILilILilILilILilZHilaLilaLilKTilILilZzilZzilKTilILilILilILilKTilZbilILilILilZzilZHilZHilZHilZHilZHilZzilKTilZbilZbilaLilaLilaLilaPilZzilZzilZbilZbilZbilZbilZbilaLilaLilaLilaLilaLilZzilZzilKTilZzilZzilZzilZzilKTilILilILilILilZE='
         return lose_msg
 
-    def run(self, scoring_function, genetic_params, num_of_iters, return_trace):
-        self.__restart()
-        # no trace
-        if not return_trace:
-            for it in range(num_of_iters):
-                rates = []
-                rotations = []
-                for c in range(TetrisEnv.MAX_TETRIS_COLS):
-                    r1, r2 = self.__calc_rank_n_rot(scoring_function, genetic_params, c)
-                    rates.append(r1)
-                    rotations.append(r2)
-                pos_to_play = rates.index(max(rates))  # plays first max found
-                rot_to_play = rotations[pos_to_play]
-                play_score = self.__play(pos_to_play, rot_to_play)
-                self.score += play_score
-                self.__gen_next_piece()
-                if play_score < 0:
-                    return self.score, self.board, self.__get_lose_msg()
-            return self.score, self.board, ""
-        else:  # we want to trace
-            board_states = []
-            ratings_n_rotations = []
-            pieces_got = []
-            # board_states.append(self.board.copy())
-            for it in range(num_of_iters):
-                rates = []
-                rotations = []
-                pieces_got.append(self.current_piece)
-                for c in range(TetrisEnv.MAX_TETRIS_COLS):
-                    r1, r2 = self.__calc_rank_n_rot(scoring_function, genetic_params, c)
-                    rates.append(r1)
-                    rotations.append(r2)
-                ratings_n_rotations.append(list(zip(rates, rotations)))
-                pos_to_play = rates.index(max(rates))  # plays first max found
-                rot_to_play = rotations[pos_to_play]
-                play_score = self.__play(pos_to_play, rot_to_play)
-                self.score += play_score
-                self.__gen_next_piece()
-                board_states.append(self.board.copy())
-                if play_score < 0:
-                    return self.score, board_states, ratings_n_rotations, pieces_got, self.__get_lose_msg()
-            return self.score, board_states, ratings_n_rotations, pieces_got, ""
-        # don't really feel like removing redundancy, cleaning code
+    # plays like run but yields a Step per placement as soon as it is played, nothing is kept
+    # between steps. Breaking out of the loop (or close()) stops the game there
+    # restart=False carries on from the current state (see set_state) instead of a new game
+    def iter_run(self, scoring_function, genetic_params, num_of_iters, with_board=False, restart=True):
+        if restart:
+            self.__restart()
+        stats = self.stats
+        for it in range(num_of_iters):
+            piece = self.current_piece
+            if stats is not None:
+                start = time.perf_counter()
+            rates, rotations = self.__rate_columns(scoring_function, genetic_params)
+            if stats is not None:
+                rated = time.perf_counter()
+                stats.add('scoring', rated - start)
+            pos_to_play = rates.index(max(rates))  # plays first max found
+            rot_to_play = rotations[pos_to_play]
+            play_score = self.__play(pos_to_play, rot_to_play)
+            if stats is not None:
+                stats.add('play', time.perf_counter() - rated)
+                stats.moves += 1
+                if play_score > 0:
+                    cleared_score = play_score - PIECE_TABLE[piece][0].pixels * TetrisEnv.SCORE_PIXEL
+                    stats.lines_cleared += TetrisEnv.LINE_SCORES.index(cleared_score)
+            self.score += play_score
+            self.__gen_next_piece()
+            yield Step(it, piece, pos_to_play, rot_to_play, play_score, self.score, rates, rotations,
+                       self.get_status()[0] if with_board else None)
+            if play_score < 0:
+                return
+
+    # profile=True adds a RunStats (time and calls per phase) at the end of the returned tuple
+    def run(self, scoring_function, genetic_params, num_of_iters, return_trace, profile=False):
+        if profile:
+            stats = self.stats = RunStats()
+            start = time.perf_counter()
+        try:
+            trace = GameTrace(num_of_iters, self.MAX_TETRIS_ROWS, self.MAX_TETRIS_COLS,
+                              self.GAMEOVER_ROWS) if return_trace else None
+            lost = False
+            for step in self.iter_run(scoring_function, genetic_params, num_of_iters):
+                if trace is not None:
+                    trace.record(step.piece, step.rates, step.rotations, step.col, step.rot)
+                    if trace.wants_keyframe():
+                        trace.keyframe(self.get_status()[0])
+                lost = step.play_score < 0
+            lose_msg = self.__get_lose_msg() if lost else ""
+            if trace is None:
+                result = self.score, self.get_status()[0], lose_msg
+            else:
+                trace.finish()
+                result = self.score, trace.board_states, trace.ratings_n_rotations, trace.pieces_got, lose_msg
+        finally:
+            if profile:  # even when the game raised, later runs must not keep timing
+                self.stats = None
+        if profile:
+            stats.add('run', time.perf_counter() - start)
+            return result + (stats,)
+        return result
+
+
+# a game in progress, see TetrisEnv.get_state, board is in the env's own format
+GameState = namedtuple('GameState', ['seed', 'board', 'current_piece', 'next_piece', 'score', 'pieces_drawn'])
+
+
+# one placement of iter_run: piece played at (col, rot) for play_score, score is the total so far,
+# rates/rotations what every column was rated, board the board after it (only with_board=True)
+Step = namedtuple('Step', ['index', 'piece', 'col', 'rot', 'play_score', 'score', 'rates', 'rotations',
+                           'board'])
+
+
+# region piece tables
+# built once at import: PIECE_TABLE[piece][rot] is the rotated form, PIECE_ROTATIONS[piece]
+# only the rotations that give a different shape (O has 1, I/S/Z have 2, the rest 4)
+PieceForm = namedtuple('PieceForm', ['shape', 'height', 'width', 'pixels', 'bottoms', 'masks', 'cells'])
+
+
+def build_piece_tables():
+    table = {}
+    rotations = {}
+    for piece, shape in TetrisEnv.Pieces.items():
+        forms = []
+        distinct = []
+        for rot in range(4):
+            rotated = np.ascontiguousarray(np.rot90(shape, rot, axes=(1, 0)))
+            # lowest filled cell of every column, the piece lands on those
+            bottoms = tuple(int(b) for b in rotated.shape[0] - 1 - np.argmax(rotated[::-1], axis=0))
+            masks = tuple(int(m) for m in rotated.astype(bool) @ (1 << np.arange(rotated.shape[1])))
+            cells = tuple(tuple(int(i) for i in axis) for axis in np.nonzero(rotated))
+            forms.append(PieceForm(rotated, rotated.shape[0], rotated.shape[1], int(np.sum(rotated)),
+                                   bottoms, masks, cells))
+            if not any(np.array_equal(rotated, forms[d].shape) for d in distinct):
+                distinct.append(rot)
+        table[piece] = tuple(forms)
+        rotations[piece] = tuple(distinct)
+    return table, rotations
+
+
+PIECE_TABLE, PIECE_ROTATIONS = build_piece_tables()
+
+
+# result of TetrisEnv.enumerate_placements, one entry per distinct placement:
+# boards (N, 24, 10) afterstates (rows cleared), scores the test_play score (penalty if game over),
+# cols/rots/rows where the piece went, index (MAX_TETRIS_COLS, 4) placement of run's (col, rot),
+# gameover_rows the env's, for the features that leave them out
+Placements = namedtuple('Placements', ['boards', 'scores', 'game_over', 'cols', 'rots', 'rows', 'index',
+                                       'gameover_rows'], defaults=(TetrisEnv.GAMEOVER_ROWS,))
+
+
+def collapse_stack(boards):
+    # clears every full row of every board in (N, rows, cols) in place, returns (boards, cleared)
+    full = np.all(boards, axis=2)
+    cleared = np.count_nonzero(full, axis=1)
+    hit = np.flatnonzero(cleared)
+    if len(hit):
+        # stable sort puts the full rows on top (in order), then zero them
+        order = np.argsort(~full[hit], axis=1, kind='stable')
+        collapsed = boards[hit[:, None], order]
+        collapsed[np.arange(boards.shape[1]) < cleared[hit, None]] = 0
+        boards[hit] = collapsed
+    return boards, cleared
+
+
+def column_tops(board):
+    # first filled row of each column, TOTAL_ROWS for an empty one
+    return np.where(board.any(axis=0), board.argmax(axis=0), board.shape[0])
+
+
+def landing_row(tops, form, col=0):
+    # the piece stops when the lowest cell of one of its columns reaches that column's top
+    chosen_row = tops[col] - form.bottoms[0]
+    for c in range(1, form.width):
+        chosen_row = min(chosen_row, tops[col + c] - form.bottoms[c])
+    return max(0, chosen_row - 1)
+
+
+# endregion
+
+
+# region bitboard engine
+# each row is a 10 bit int, bit j is column j, so a piece row at col c is its mask << c
+FULL_ROW = (1 << TetrisEnv.MAX_TETRIS_COLS) - 1  # 0x3FF, BitTetrisEnv.FULL_ROW for other widths
+
+
+def col_bits(cols):
+    # bit of every column, python ints past what an int64 holds
+    return 1 << np.arange(cols, dtype=np.int64 if cols < 63 else object)
+
+
+def board_to_rows(board):
+    return (board.astype(bool) @ col_bits(board.shape[1])).tolist()
+
+
+def rows_to_board(rows, cols=TetrisEnv.MAX_TETRIS_COLS):
+    bits = col_bits(cols)
+    return ((np.asarray(rows, dtype=bits.dtype)[:, None] & bits) > 0).astype(np.byte)
+
+
+def rows_column_tops(rows, cols=TetrisEnv.MAX_TETRIS_COLS):
+    # column_tops for row masks, stops as soon as every column has been seen
+    tops = [len(rows)] * cols
+    full_row = (1 << cols) - 1
+    seen = 0
+    for r in range(len(rows)):
+        new = rows[r] & ~seen
+        if new:
+            seen |= new
+            for c in range(cols):
+                if new >> c & 1:
+                    tops[c] = r
+            if seen == full_row:
+                break
+    return tops
+
+
+class BitTetrisEnv(TetrisEnv):
+    # same game as TetrisEnv (same seed -> same pieces, same score), but the board is a list
+    # of row masks so collisions are ANDs and a full row is a compare, no small numpy calls
+    def __init__(self, rows=None, cols=None, gameover_rows=None):
+        super().__init__(rows, cols, gameover_rows)
+        self.FULL_ROW = (1 << self.MAX_TETRIS_COLS) - 1
+
+    def empty_board(self):
+        return [0] * self.TOTAL_ROWS
+
+    def get_status(self):
+        # scoring functions expect the array board, the masks stay inside the env
+        return rows_to_board(self.board, self.MAX_TETRIS_COLS), self.current_piece, self.next_piece
+
+    def __drop(self, rows, tops, piece_type, col, rot_count):
+        form = PIECE_TABLE[piece_type][rot_count % 4]
+        col = min(col, self.MAX_TETRIS_COLS - form.width)
+        chosen_row = landing_row(tops, form, col)
+        for k in range(form.height):
+            rows[chosen_row + k] |= form.masks[k] << col
+        kept = [r for r in rows if r != self.FULL_ROW]
+        cleared = self.TOTAL_ROWS - len(kept)
+        if cleared:
+            rows = [0] * cleared + kept
+            if self.stats is not None:  # collapse time stays inside test_play here
+                self.stats.collapses += 1
+        if any(rows[:self.GAMEOVER_ROWS]):
+            return TetrisEnv.GAMEOVER_PENALTY, rows
+        return TetrisEnv.LINE_SCORES[cleared] + form.pixels * TetrisEnv.SCORE_PIXEL, rows
+
+    # takes either an array board (as from get_status) or a list of row masks and returns the
+    # same kind, unlike TetrisEnv.test_play the board given is never changed in place
+    def test_play(self, board_copy, piece_type, col, rot_count, summary=None):
+        if summary is not None:
+            summary.play(piece_type, col, rot_count)
+        if self.stats is not None:
+            return self.stats.timed('test_play', self.__test_play, board_copy, piece_type, col, rot_count)
+        return self.__test_play(board_copy, piece_type, col, rot_count)
+
+    def __test_play(self, board_copy, piece_type, col, rot_count):
+        if isinstance(board_copy, np.ndarray):
+            score, rows = self.__drop(board_to_rows(board_copy), column_tops(board_copy).tolist(),
+                                      piece_type, col, rot_count)
+            return score, rows_to_board(rows, self.MAX_TETRIS_COLS)
+        return self.__drop(list(board_copy), rows_column_tops(board_copy, self.MAX_TETRIS_COLS), piece_type, col,
+                           rot_count)
+
+    def place_piece(self, board, piece_type, col, rot_count):
+        if isinstance(board, np.ndarray):
+            return super().place_piece(board, piece_type, col, rot_count)
+        form = PIECE_TABLE[piece_type][rot_count % 4]
+        col = min(col, self.MAX_TETRIS_COLS - form.width)
+        rows = list(board)
+        row = landing_row(rows_column_tops(rows, self.MAX_TETRIS_COLS), form, col)
+        for k in range(form.height):
+            rows[row + k] |= form.masks[k] << col
+        return rows
+
+    def enumerate_placements(self, board, piece_type):
+        if not isinstance(board, np.ndarray):
+            board = rows_to_board(board, self.MAX_TETRIS_COLS)
+        return super().enumerate_placements(board, piece_type)
+
+
+# endregion
+
+
+# region board summary
+# bit r of a column mask is row r of that column (row 0 on top)
+class BoardSummary:
+    # what the rating functions read of a board, kept up to date by play() instead of being
+    # recomputed from the whole board: column masks, filled cells per row, column heights
+    # (get_peaks) and every column's count_holes_t1 / t2 part, plus the totals the features are.
+    # A placement only touches the piece's columns and rows, a collapse only the cleared rows
+    def __init__(self, columns, rows=TetrisEnv.TOTAL_ROWS, gameover_rows=TetrisEnv.GAMEOVER_ROWS):
+        self.columns = list(columns)
+        self.rows = rows
+        self.cols = len(self.columns)
+        self.gameover_rows = gameover_rows
+        self.t1_rows = (1 << (rows - 1)) - 1  # pairs (r, r + 1) count_holes_t1 looks at
+        self.t2_rows = (1 << (rows - 2)) - 1  # triples (r, r + 1, r + 2) of count_holes_t2
+        self.row_fill = [0] * self.rows
+        for m in self.columns:
+            for r in range(self.rows):
+                self.row_fill[r] += m >> r & 1
+        self.line_continuation = sum(f * f for f in self.row_fill)
+        self.heights = [0] * self.cols
+        self.t1 = [0] * self.cols
+        self.t2 = [0] * self.cols
+        self.holes_t1 = self.holes_t2 = 0
+        for c in range(self.cols):
+            self.__refresh_column(c)
+
+    @classmethod
+    def from_board(cls, board, cols=TetrisEnv.MAX_TETRIS_COLS, gameover_rows=TetrisEnv.GAMEOVER_ROWS):
+        # an array board or a list of row masks (cols wide)
+        if isinstance(board, np.ndarray):
+            cols = board.shape[1]
+            board = board_to_rows(board)
+        return cls([sum((row >> c & 1) << r for r, row in enumerate(board)) for c in range(cols)], len(board),
+                   gameover_rows)
+
+    def copy(self):
+        other = BoardSummary.__new__(BoardSummary)
+        other.columns = self.columns.copy()
+        other.rows = self.rows
+        other.cols = self.cols
+        other.gameover_rows = self.gameover_rows
+        other.t1_rows = self.t1_rows
+        other.t2_rows = self.t2_rows
+        other.row_fill = self.row_fill.copy()
+        other.line_continuation = self.line_continuation
+        other.heights = self.heights.copy()
+        other.t1 = self.t1.copy()
+        other.t2 = self.t2.copy()
+        other.holes_t1 = self.holes_t1
+        other.holes_t2 = self.holes_t2
+        return other
+
+    def __refresh_column(self, c):
+        m = self.columns[c]
+        self.heights[c] = self.rows - ((m & -m).bit_length() - 1) if m else 0
+        t1 = (m & ~(m >> 1) & self.t1_rows).bit_count()  # filled over empty
+        t2 = (m & (m >> 1) & ~(m >> 2) & self.t2_rows).bit_count()  # two filled over empty
+        self.holes_t1 += t1 - self.t1[c]
+        self.holes_t2 += t2 - self.t2[c]
+        self.t1[c] = t1
+        self.t2[c] = t2
+
+    def max_height(self):
+        return max(0, max(self.heights) - self.gameover_rows)
+
+    def play(self, piece_type, col, rot_count):
+        # same placement, collapse and score as TetrisEnv.test_play, on the summary in place
+        form = PIECE_TABLE[piece_type][rot_count % 4]
+        col = min(col, self.cols - form.width)
+        tops = [self.rows - h for h in self.heights]
+        chosen_row = landing_row(tops, form, col)
+        for r, c in zip(form.cells[0], form.cells[1]):
+            bit = 1 << (chosen_row + r)
+            if not self.columns[col + c] & bit:
+                self.columns[col + c] |= bit
+                self.line_continuation += 2 * self.row_fill[chosen_row + r] + 1
+                self.row_fill[chosen_row + r] += 1
+        full = [r for r in range(chosen_row, chosen_row + form.height)
+                if self.row_fill[r] == self.cols]
+        if full:
+            self.__collapse(full)
+        else:
+            for c in range(col, col + form.width):
+                self.__refresh_column(c)
+        if max(self.heights) > self.rows - self.gameover_rows:
+            return TetrisEnv.GAMEOVER_PENALTY
+        return TetrisEnv.LINE_SCORES[len(full)] + form.pixels * TetrisEnv.SCORE_PIXEL
+
+    def __collapse(self, full):
+        # top most first, a row removed only moves the rows above it
+        for r in full:
+            above = (1 << r) - 1
+            for c in range(self.cols):
+                m = self.columns[c]
+                self.columns[c] = (m >> (r + 1) << (r + 1)) | (m & above) << 1
+            del self.row_fill[r]
+            self.row_fill.insert(0, 0)
+        self.line_continuation -= len(full) * self.cols ** 2
+        for c in range(self.cols):
+            self.__refresh_column(c)
+
+
+# endregion
+
+
+# region profiling
+class RunStats:
+    # what a profiled run spent its time on: wall clock seconds and calls per phase
+    # (run, scoring, play, test_play, enumerate_placements, collapse, game_over), moves, lines the
+    # game cleared and collapses (test_plays, scoring ones too, that cleared rows).
+    # BitTetrisEnv does collapse and game over inside test_play, they have no phase of their own.
+    # run(..., profile=True) makes one, or set env.stats = RunStats() before iter_run
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.moves = 0
+        self.lines_cleared = 0
+        self.collapses = 0
+
+    def add(self, phase, seconds):
+        self.seconds[phase] += seconds
+        self.calls[phase] += 1
+
+    def timed(self, phase, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.add(phase, time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        moves = max(1, self.moves)
+        phases = {phase: {'seconds': self.seconds[phase], 'calls': self.calls[phase],
+                          'mean_seconds': self.seconds[phase] / max(1, self.calls[phase])}
+                  for phase in sorted(set(self.seconds) | set(self.calls))}
+        return {'moves': self.moves, 'lines_cleared': self.lines_cleared, 'collapses': self.collapses,
+                'phases': phases,
+                # the play itself is one test_play too, these are the scoring function's
+                'test_play_per_move': (self.calls['test_play'] - self.calls['play']) / moves,
+                'scoring_seconds_per_move': self.seconds['scoring'] / moves,
+                'play_seconds_per_move': self.seconds['play'] / moves}
+
+    def __repr__(self):
+        lines = ['moves %d, lines cleared %d, collapses %d, scoring test_plays per move %.1f'
+                 % (self.moves, self.lines_cleared, self.collapses, self.summary()['test_play_per_move'])]
+        for phase, info in self.summary()['phases'].items():
+            lines.append('  %-22s %10.4f s %9d calls %10.2f us/call'
+                         % (phase, info['seconds'], info['calls'], info['mean_seconds'] * 1e6))
+        return '\n'.join(lines)
+
+
+# endregion
+
+
+# region traces
+class TraceView:
+    # read only sequence over a GameTrace, what run(return_trace=True) hands back in place of lists
+    def __init__(self, trace, getter, iterator=None):
+        self.trace = trace
+        self.__getter = getter
+        self.__iterator = iterator
+
+    def __len__(self):
+        return self.trace.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.__getter(j) for j in range(*i.indices(self.trace.length))]
+        if i < 0:
+            i += self.trace.length
+        if not 0 <= i < self.trace.length:
+            raise IndexError('trace index out of range')
+        return self.__getter(i)
+
+    def __iter__(self):
+        if self.__iterator is not None:
+            return self.__iterator()
+        return (self.__getter(i) for i in range(self.trace.length))
+
+
+def mask_dtype(bits):
+    # smallest unsigned dtype holding a bits wide mask, python ints past 64
+    for dtype in (np.uint16, np.uint32, np.uint64):
+        if bits <= np.iinfo(dtype).bits:
+            return dtype
+    return object
+
+
+class GameTrace:
+    # one traced game in preallocated arrays: per step the piece (index in TETRIS_PIECES), the
+    # played col/rot, every column's rating (float32) and rotation (2 bits each). Boards are not
+    # kept, board i is replayed from the row mask keyframe stored every KEYFRAME_EVERY steps.
+    # rows/cols/gameover_rows are the traced env's
+    KEYFRAME_EVERY = 64
+
+    def __init__(self, capacity, rows=TetrisEnv.MAX_TETRIS_ROWS, cols=TetrisEnv.MAX_TETRIS_COLS,
+                 gameover_rows=TetrisEnv.GAMEOVER_ROWS):
+        self.geometry = (rows, cols, gameover_rows)
+        self.length = 0
+        self.pieces = np.zeros(capacity, dtype=np.uint8)
+        self.cols = np.zeros(capacity, dtype=np.uint8 if cols <= 256 else np.uint16)
+        self.rots = np.zeros(capacity, dtype=np.uint8)
+        self.ratings = np.zeros((capacity, cols), dtype=np.float32)
+        self.rotations = np.zeros(capacity, dtype=mask_dtype(2 * cols))
+        self.keyframes = np.zeros((capacity // self.KEYFRAME_EVERY + 1, rows + gameover_rows),
+                                  dtype=mask_dtype(cols))
+        self.__replay_env = None
+        self.board_states = TraceView(self, self.board, self.iter_boards)
+        self.ratings_n_rotations = TraceView(self, self.ratings_and_rotations)
+        self.pieces_got = TraceView(self, self.piece)
+
+    def wants_keyframe(self):
+        return self.length % self.KEYFRAME_EVERY == 0
+
+    def keyframe(self, board):
+        # board before step self.length (the empty board before step 0 is already there)
+        self.keyframes[self.length // self.KEYFRAME_EVERY] = board_to_rows(board)
+
+    def record(self, piece, rates, rotations, col, rot):
+        i = self.length
+        self.pieces[i] = TetrisEnv.TETRIS_PIECES.index(piece)
+        self.cols[i] = col
+        self.rots[i] = rot
+        self.ratings[i] = rates
+        packed = 0
+        for c, r in enumerate(rotations):
+            packed |= int(r) << (2 * c)
+        self.rotations[i] = packed
+        self.length += 1
+
+    def finish(self):
+        # drop the unused part of the preallocated arrays
+        n = self.length
+        self.pieces = self.pieces[:n].copy()
+        self.cols = self.cols[:n].copy()
+        self.rots = self.rots[:n].copy()
+        self.ratings = self.ratings[:n].copy()
+        self.rotations = self.rotations[:n].copy()
+        self.keyframes = self.keyframes[:(n + self.KEYFRAME_EVERY - 1) // self.KEYFRAME_EVERY].copy()
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.pieces, self.cols, self.rots, self.ratings, self.rotations,
+                                      self.keyframes))
+
+    def piece(self, i):
+        return TetrisEnv.TETRIS_PIECES[self.pieces[i]]
+
+    def ratings_and_rotations(self, i):
+        packed = int(self.rotations[i])
+        return [(float(self.ratings[i, c]), packed >> (2 * c) & 3) for c in range(self.ratings.shape[1])]
+
+    def __replay(self, rows, i):
+        # row masks after step i from the row masks before it
+        if self.__replay_env is None:
+            self.__replay_env = BitTetrisEnv(*self.geometry)
+        env = self.__replay_env
+        score, after = env.test_play(rows, self.piece(i), int(self.cols[i]), int(self.rots[i]))
+        if score == TetrisEnv.GAMEOVER_PENALTY:  # the board a lost game was left with, see __play
+            return env.place_piece(rows, self.piece(i), int(self.cols[i]), int(self.rots[i]))
+        return after
+
+    def board(self, i):
+        # board after step i
+        start = min((i + 1) // self.KEYFRAME_EVERY, len(self.keyframes) - 1) * self.KEYFRAME_EVERY
+        rows = self.keyframes[start // self.KEYFRAME_EVERY].tolist()
+        for step in range(start, i + 1):
+            rows = self.__replay(rows, step)
+        return rows_to_board(rows, self.ratings.shape[1])
+
+    def iter_boards(self):
+        rows = [0] * self.keyframes.shape[1]
+        for i in range(self.length):
+            rows = self.__replay(rows, i)
+            yield rows_to_board(rows, self.ratings.shape[1])
+
+
+# endregion
+
+
+# region play cache
+class PlayCache:
+    # LRU of test_play results keyed by (packed board, piece, clamped col, distinct rotation), so
+    # columns clamped to the same spot and rotations of the same shape are simulated only once.
+    # Stored afterstates are read only, test_play them through play (never in place)
+    def __init__(self, max_size=20000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def board_key(board):
+        return np.packbits(board).tobytes()  # 30 bytes for 24x10
+
+    def play(self, tetris_env, board, piece_type, col, rot_count, board_key=None):
+        form = PIECE_TABLE[piece_type][rot_count % 4]
+        col = min(col, tetris_env.MAX_TETRIS_COLS - form.width)
+        rot_count = rot_count % len(PIECE_ROTATIONS[piece_type])
+        if board_key is None:
+            board_key = self.board_key(board)
+        key = (board_key, piece_type, col, rot_count)
+        found = self.entries.get(key)
+        if found is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return found
+        self.misses += 1
+        score, after = tetris_env.test_play(board.copy(), piece_type, col, rot_count)
+        after.flags.writeable = False
+        self.entries[key] = (score, after)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return score, after
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+
+# endregion
+
+
+# region piece sequences
+PIECE_CODES = {p: i for i, p in enumerate(TetrisEnv.TETRIS_PIECES)}
+
+
+def piece_sequence(seed, length):
+    # the first `length` pieces a TetrisEnv with this seed gets, as indices into TETRIS_PIECES
+    rng = Random(seed)
+    return np.array([PIECE_CODES[rng.choice(TetrisEnv.TETRIS_PIECES)] for _ in range(length)], dtype=np.uint8)
+
+
+class PieceSequences:
+    # every seed's piece_sequence made once and kept. With a directory the sequences are also raw
+    # uint8 files there opened as read only memmaps, so worker processes pointed at the same
+    # directory share one copy (the OS page cache) instead of making their own.
+    # A longer sequence of a seed starts with the shorter one, so only the longest is kept
+    def __init__(self, directory=None, min_length=1024):
+        self.directory = directory
+        self.min_length = min_length
+        self.sequences = {}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, seed):
+        return os.path.join(self.directory, 'pieces_%s.u8' % seed)
+
+    def get(self, seed, length):
+        sequence = self.sequences.get(seed)
+        if sequence is None and self.directory is not None:
+            sequence = self.__load(seed)
+        if sequence is None or len(sequence) < length:
+            longer = 2 * len(sequence) if sequence is not None else 0
+            sequence = piece_sequence(seed, max(length, longer, self.min_length))
+            if self.directory is not None:
+                self.__save(seed, sequence)
+                sequence = self.__load(seed)
+        self.sequences[seed] = sequence
+        return sequence
+
+    def __load(self, seed):
+        path = self.path(seed)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None
+        return np.memmap(path, dtype=np.uint8, mode='r')
+
+    def __save(self, seed, sequence):
+        # written aside and renamed, a process reading it never sees half a file
+        import tempfile  # only writers need it, keeps importing TetrisSIE quick
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(sequence.tobytes())
+        os.replace(tmp_path, self.path(seed))
+
+
+# endregion
 
 
 # max gain + random
 def random_scoring_function(tetris_env: TetrisEnv, gen_params, col):
     board, piece, next_piece = tetris_env.get_status()  # add type hinting
+    # every play goes through the cache, it works on copies so the board is not
+    # changed in place between rotations anymore (same issue eternal had)
+    cache = tetris_env.play_cache
+    board_key = cache.board_key(board)
     scores = []
     for i in range(4):
-        score, tmp_board = tetris_env.test_play(board, piece, col, i)
+        score, tmp_board = cache.play(tetris_env, board, piece, col, i, board_key)
         if score < 0:
             scores.append([score * gen_params[0], i])
             continue
+        tmp_key = cache.board_key(tmp_board)
         tmp_scores = []
         for t in range(tetris_env.MAX_TETRIS_COLS):
             for j in range(4):
-                score2, _ = tetris_env.test_play(tmp_board, next_piece, t, j)
+                score2, _ = cache.play(tetris_env, tmp_board, next_piece, t, j, tmp_key)
                 tmp_scores.append(score2 * gen_params[1])
         max_score2 = max(tmp_scores)
         if max_score2 >= 0:
@@ -243,20 +935,29 @@ def random_scoring_function(tetris_env: TetrisEnv, gen_params, col):
     return val[0], val[1]
 
 
-def print_stats(use_visuals_in_trace_p, states_p, pieces_p, sleep_time_p):
-    vision = BoardVision()
+# states_p can also be an iter_run(..., with_board=True) stream with pieces_p None,
+# it is shown while it is played then. gameover_rows is the env's the boards came from
+def print_stats(use_visuals_in_trace_p, states_p, pieces_p, sleep_time_p, gameover_rows=TetrisEnv.GAMEOVER_ROWS):
+    if pieces_p is None:
+        states_n_pieces = ((step.board, step.piece) for step in states_p)
+    else:
+        states_n_pieces = zip(states_p, pieces_p)
     if use_visuals_in_trace_p:
-
-        for state, piece in zip(states_p, pieces_p):
+        from Visor import BoardVision
+        vision = None
+        for state, piece in states_n_pieces:
+            if vision is None:  # as big as the boards are
+                vision = BoardVision(state.shape[0] - gameover_rows, state.shape[1], gameover_rows)
             vision.update_board(state)
             # print("piece")
             # condensed_print(piece)
             # print('-----')
             time.sleep(sleep_time_p)
         time.sleep(2)
-        vision.close()
+        if vision is not None:
+            vision.close()
     else:
-        for state, piece in zip(states_p, pieces_p):
+        for state, piece in states_n_pieces:
             print("board")
             condensed_print(state)
             print("piece")
@@ -290,8 +991,11 @@ def print_stats(use_visuals_in_trace_p, states_p, pieces_p, sleep_time_p):
 
 
 # region my functions
+# these also take a BoardSummary (TetrisEnv.summary..) and read what it keeps up to date
 def count_holes_t1(board):
     # count top rows bigger than bottom
+    if isinstance(board, BoardSummary):
+        return board.holes_t1
     return np.sum(board[:-1] > board[1:])
 
 
@@ -300,21 +1004,27 @@ def count_holes_t2(board):
     # the 1:-1 here because you are comparing a point with the 2 points above it
     # the second line is not factored in this calculation and both matrices need to have
     # same size for it to have meaning
+    if isinstance(board, BoardSummary):
+        return board.holes_t2
     return np.sum(np.multiply(board[1:-1] > board[2:], board[:-2] > board[2:]))
 
 
 def line_continuation(board):
+    if isinstance(board, BoardSummary):
+        return board.line_continuation
     return np.sum(np.square(np.sum(board, axis=1)))
 
 
-def max_height(board):
+def max_height(board, gameover_rows=TetrisEnv.GAMEOVER_ROWS):
+    if isinstance(board, BoardSummary):
+        return board.max_height()
     h = 0
     vals = np.sum(board, axis=1)
     for i in range(vals.shape[0]):
         if vals[i] > 0:
-            h = 24 - i
+            h = vals.shape[0] - i
             break
-    h = max(0, h - 4)  # ignore first 4 rows
+    h = max(0, h - gameover_rows)  # ignore the game over rows
     return h
 
 
@@ -332,6 +1042,8 @@ def left_best(col):  # give bias to putting things on the left when there is no
 
 # region extra functions (not my ideas):
 def get_peaks(area):
+    if isinstance(area, BoardSummary):
+        return np.array(area.heights, dtype=float)
     peaks = np.array([])
     for col in range(area.shape[1]):
         if 1 in area[:, col]:
@@ -352,7 +1064,7 @@ def highest_peak(peaks):
 
 def get_bumpiness(peaks):
     s = 0
-    for i in range(TetrisEnv.MAX_TETRIS_COLS - 1):
+    for i in range(len(peaks) - 1):
         s += np.abs(peaks[i] - peaks[i + 1])
     return s
 
@@ -432,11 +1144,116 @@ def col_transition(board):  # similar to holes a bit
     return np.sum(board[:-1] != board[1:])
 
 
+# region batched features
+# same ratings as the functions above, but over a stack of boards (N, rows, cols) -> (N,),
+# so rating every placement of a move is a fixed number of numpy passes and not a loop.
+# A chromosome names its features (see linear_scoring) instead of relying on list positions
+FEATURES = {}
+COLUMN_FEATURES = {'left_best': left_best}  # rate the column asked for, not the board
+GAMEOVER_ROW_FEATURES = set()  # also take the board's gameover_rows
+
+
+def register_feature(name, uses_gameover_rows=False):
+    def register(feature_function):
+        FEATURES[name] = feature_function
+        if uses_gameover_rows:
+            GAMEOVER_ROW_FEATURES.add(name)
+        return feature_function
+    return register
+
+
+def batch_features(boards, names, gameover_rows=TetrisEnv.GAMEOVER_ROWS):
+    # (N, F) feature matrix, column f is FEATURES[names[f]]
+    features = np.empty((boards.shape[0], len(names)))
+    for f, name in enumerate(names):
+        if name in GAMEOVER_ROW_FEATURES:
+            features[:, f] = FEATURES[name](boards, gameover_rows)
+        else:
+            features[:, f] = FEATURES[name](boards)
+    return features
+
+
+def batch_peaks(boards):
+    filled = boards == 1
+    return np.where(filled.any(axis=1), boards.shape[1] - np.argmax(filled, axis=1), 0)
+
+
+def batch_wells(peaks):
+    rise = np.diff(peaks, axis=1)
+    left = np.zeros_like(peaks)
+    right = np.zeros_like(peaks)
+    left[:, 1:] = np.maximum(-rise, 0)  # neighbour on the left is higher
+    right[:, :-1] = np.maximum(rise, 0)
+    return np.maximum(left, right)
+
+
+@register_feature('count_holes_t1')
+def batch_holes_t1(boards):
+    return np.sum(boards[:, :-1] > boards[:, 1:], axis=(1, 2))
+
+
+@register_feature('count_holes_t2')
+def batch_holes_t2(boards):
+    return np.sum((boards[:, 1:-1] > boards[:, 2:]) & (boards[:, :-2] > boards[:, 2:]), axis=(1, 2))
+
+
+@register_feature('line_continuation')
+def batch_line_continuation(boards):
+    return np.sum(np.square(np.sum(boards, axis=2, dtype=np.int64)), axis=1)
+
+
+@register_feature('max_height', uses_gameover_rows=True)
+def batch_max_height(boards, gameover_rows=TetrisEnv.GAMEOVER_ROWS):
+    filled = boards.any(axis=2)
+    h = np.where(filled.any(axis=1), boards.shape[1] - np.argmax(filled, axis=1), 0)
+    return np.maximum(0, h - gameover_rows)  # ignore the game over rows
+
+
+@register_feature('aggregated_height')
+def batch_aggregated_height(boards):
+    return np.sum(batch_peaks(boards), axis=1)
+
+
+@register_feature('highest_peak')
+def batch_highest_peak(boards):
+    return np.max(batch_peaks(boards), axis=1)
+
+
+@register_feature('bumpiness')
+def batch_bumpiness(boards):
+    return np.sum(np.abs(np.diff(batch_peaks(boards), axis=1)), axis=1)
+
+
+@register_feature('cols_with_holes')
+def batch_cols_with_holes(boards):
+    return np.count_nonzero(np.any(boards[:, :-1] > boards[:, 1:], axis=1), axis=1)
+
+
+@register_feature('deepest_well')
+def batch_deepest_well(boards):
+    return np.max(batch_wells(batch_peaks(boards)), axis=1)
+
+
+@register_feature('row_transition')
+def batch_row_transition(boards):
+    return np.sum(boards[:, :, :-1] != boards[:, :, 1:], axis=(1, 2))
+
+
+@register_feature('col_transition')
+def batch_col_transition(boards):
+    return np.sum(boards[:, :-1] != boards[:, 1:], axis=(1, 2))
+
+
+# endregion
+
+
 def eternal(tetris_env: TetrisEnv, gen_params, col):
-    board, piece, next_piece = tetris_env.get_status()  # add type hinting
+    piece = tetris_env.current_piece
     scores = []
     for i in range(4):
-        score, tmp_board = tetris_env.test_play(board.copy(), piece, col, i)
+        # every rating below reads the summary, no board needs to be simulated
+        tmp_board = tetris_env.summary.copy()
+        score = tmp_board.play(piece, col, i)
         # condensed_print(tmp_board)
         # print("test")
         # score *= gen_params[5]
@@ -488,6 +1305,109 @@ def eternal(tetris_env: TetrisEnv, gen_params, col):
     return val[0], val[1]
 
 
+
+def batch_scoring(scoring_function):
+    # marks a scoring function that rates all placements of a move in one call:
+    # scoring_function(tetris_env, gen_params, placements) -> (MAX_TETRIS_COLS, 4) grid of
+    # ratings for run's (col, rot), placements being TetrisEnv.enumerate_placements' result
+    scoring_function.batched = True
+    return scoring_function
+
+
+def rate_placements(placements, feature_names, gen_params):
+    # score + board features . weights of every placement, game overs keep just their penalty
+    used = feature_names[:len(gen_params)]
+    board_names = [name for name in used if name not in COLUMN_FEATURES]
+    board_weights = [w for name, w in zip(used, gen_params) if name not in COLUMN_FEATURES]
+    rated = placements.scores.astype(float)
+    alive = ~placements.game_over
+    if board_names and alive.any():
+        rated[alive] += batch_features(placements.boards[alive], board_names, placements.gameover_rows) @ \
+            board_weights
+    return rated
+
+
+def rating_grid(placements, rated, feature_names, gen_params):
+    # per placement ratings to run's (col, rot) grid, column features added to the live ones
+    used = feature_names[:len(gen_params)]
+    asked_cols = np.arange(placements.index.shape[0])
+    col_rating = np.zeros(len(asked_cols))
+    for name, w in zip(used, gen_params):
+        if name in COLUMN_FEATURES:
+            col_rating += COLUMN_FEATURES[name](asked_cols) * w
+    grid = rated[placements.index]
+    return np.where(placements.game_over[placements.index], grid, grid + col_rating[:, None])
+
+
+def linear_scoring(feature_names):
+    # batched scoring function rating a placement as its score + features . gen_params,
+    # gen_params[i] is the weight of feature_names[i] (a shorter chromosome uses the first ones)
+    @batch_scoring
+    def scoring_function(tetris_env: TetrisEnv, gen_params, placements):
+        rated = rate_placements(placements, feature_names, gen_params)
+        return rating_grid(placements, rated, feature_names, gen_params)
+
+    scoring_function.features = tuple(feature_names)
+    return scoring_function
+
+
+ETERNAL_FEATURES = ('count_holes_t1', 'count_holes_t2', 'line_continuation', 'max_height', 'left_best')
+# eternal over the whole batch, same ratings, every afterstate simulated once
+eternal_batch = linear_scoring(ETERNAL_FEATURES)
+
+
+# region beam search
+def beam_scoring(feature_names, depth=2, beam_width=5, time_budget=None):
+    # batched scoring function looking depth pieces ahead: the linear rating only rates the last
+    # ply, the beam_width best placements of a ply (by their own linear rating) are expanded with
+    # next_piece, deeper than that with every piece (mean of their best). A placement is worth its
+    # score + the best value after it, placements out of the beam are -inf.
+    # time_budget (seconds per move) stops expanding when it runs out, beam placements it didn't
+    # get to keep their linear rating: with no time at all the move is linear_scoring's.
+    # depth=1 is linear_scoring, beam_width=34 is the full search. simulations counts the
+    # placements enumerated, random_scoring_function's exhaustive 2 plies are 1600 per move
+    def plan(tetris_env, placements, gen_params, pieces, plies, deadline):
+        rated = rate_placements(placements, feature_names, gen_params)
+        if plies <= 1 or (deadline is not None and time.perf_counter() > deadline):
+            return rated
+        # linear_scoring's rating of every placement, its best (col, rot) with column features in
+        grid = rating_grid(placements, rated, feature_names, gen_params)
+        linear = np.full(len(rated), -np.inf)
+        np.maximum.at(linear, placements.index.ravel(), grid.ravel())
+        alive = np.flatnonzero(~placements.game_over)
+        beam = alive[np.argsort(-linear[alive], kind='stable')[:beam_width]]
+        values = np.where(placements.game_over, rated, -np.inf)
+        values[beam] = rated[beam]  # until expanded
+        for b in beam:
+            if deadline is not None and time.perf_counter() > deadline:
+                break
+            after = []
+            for piece in pieces[:1] or TetrisEnv.TETRIS_PIECES:
+                deeper = tetris_env.enumerate_placements(placements.boards[b], piece)
+                scoring_function.simulations += len(deeper.scores)
+                after.append(np.max(plan(tetris_env, deeper, gen_params, pieces[1:], plies - 1, deadline)))
+            values[b] = placements.scores[b] + np.mean(after)
+        return values
+
+    @batch_scoring
+    def scoring_function(tetris_env: TetrisEnv, gen_params, placements):
+        scoring_function.simulations += len(placements.scores)
+        deadline = None if time_budget is None else time.perf_counter() + time_budget
+        values = plan(tetris_env, placements, gen_params, [tetris_env.next_piece], depth, deadline)
+        return rating_grid(placements, values, feature_names, gen_params)
+
+    scoring_function.features = tuple(feature_names)
+    scoring_function.simulations = 0
+    return scoring_function
+
+
+# eternal's weights with the next piece in mind
+eternal_beam = beam_scoring(ETERNAL_FEATURES)
+
+
+# endregion
+
+
 if __name__ == "__main__":
     use_visuals_in_trace = True
     sleep_time = 0.1
@@ -512,7 +1432,7 @@ if __name__ == "__main__":
 
     print(total_score)
     print(msg)
-    print_stats(use_visuals_in_trace, states, pieces, sleep_time)
+    print_stats(use_visuals_in_trace, states, pieces, sleep_time, env.GAMEOVER_ROWS)
     # env.set_seed(5132)
     # total_score, states, rate_rot, pieces, msg = env.run(
     #     eternal, one_chromo_rando, 100, True)
@@ -0,0 +1,210 @@
+import json
+import os
+
+import numpy as np
+
+import TetrisSIE
+from TetrisSIE import TetrisEnv, board_to_rows, rows_to_board, batch_features, mask_dtype
+
+# append only on disk corpus of traced games, read through memmaps so a step or the same step of
+# thousands of games is read without loading anything else. A directory of
+#   meta.json   geometry and chromosome length, what the record dtypes are made from
+#   games.bin   one record per game: seed, chromosome, scoring function, first step, length, score
+#   steps.bin   one record per step: piece, played col/rot, play score, total score, every column's
+#               rating and rotation, and the board after it as row masks (no replay needed)
+# Steps of a game are written before its game record, so a game is in the corpus only once all of
+# it is. Single writer, any number of readers (they see the games there when they last looked)
+META_VERSION = 1
+
+
+def step_dtype(rows, cols, gameover_rows):
+    return np.dtype([('piece', np.uint8), ('col', np.uint16), ('rot', np.uint8), ('play_score', np.int32),
+                     ('score', np.int64), ('ratings', np.float32, (cols,)), ('rotations', np.uint8, (cols,)),
+                     ('rows', mask_dtype(cols), (rows + gameover_rows,))])
+
+
+def game_dtype(num_of_genes):
+    return np.dtype([('seed', np.int64), ('chromo', np.float64, (num_of_genes,)), ('scoring', 'S32'),
+                     ('start', np.int64), ('length', np.int64), ('score', np.int64), ('lost', np.bool_)])
+
+
+class TraceCorpus:
+    def __init__(self, directory, num_of_genes=5, rows=TetrisEnv.MAX_TETRIS_ROWS, cols=TetrisEnv.MAX_TETRIS_COLS,
+                 gameover_rows=TetrisEnv.GAMEOVER_ROWS):
+        # an existing corpus keeps its own geometry and chromosome length, the arguments are for new ones
+        self.directory = directory
+        meta_path = os.path.join(directory, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['version'] != META_VERSION:
+                raise ValueError('corpus version %d, expected %d' % (meta['version'], META_VERSION))
+            num_of_genes, rows, cols, gameover_rows = meta['num_of_genes'], meta['rows'], meta['cols'], \
+                meta['gameover_rows']
+        else:
+            if cols > 64:
+                raise ValueError('corpus boards are at most 64 columns wide')
+            os.makedirs(directory, exist_ok=True)
+            with open(meta_path, 'w') as f:
+                json.dump({'version': META_VERSION, 'num_of_genes': num_of_genes, 'rows': rows, 'cols': cols,
+                           'gameover_rows': gameover_rows}, f)
+        self.num_of_genes = num_of_genes
+        self.geometry = (rows, cols, gameover_rows)
+        self.step_dtype = step_dtype(rows, cols, gameover_rows)
+        self.game_dtype = game_dtype(num_of_genes)
+        self.games_path = os.path.join(directory, 'games.bin')
+        self.steps_path = os.path.join(directory, 'steps.bin')
+        self.__games = None
+        self.__steps = None
+
+    # region reading
+    def __map(self, path, dtype):
+        count = os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+    @property
+    def games(self):
+        # (games,) records, remapped when games were added since
+        size = os.path.getsize(self.games_path) if os.path.exists(self.games_path) else 0
+        if self.__games is None or len(self.__games) * self.game_dtype.itemsize != size:
+            self.__games = self.__map(self.games_path, self.game_dtype)
+            self.__steps = None
+        return self.__games
+
+    @property
+    def steps(self):
+        # (steps,) records of every game, game g's are steps[start:start + length]
+        self.games  # remaps steps too when there are new games
+        if self.__steps is None:
+            self.__steps = self.__map(self.steps_path, self.step_dtype)
+        return self.__steps
+
+    def __len__(self):
+        return len(self.games)
+
+    def find(self, seed=None, chromo=None, scoring_name=None):
+        # ids of the games matching all the given ones
+        games = self.games
+        match = np.ones(len(games), dtype=bool)
+        if seed is not None:
+            match &= games['seed'] == seed
+        if chromo is not None:
+            padded = np.zeros(self.num_of_genes)
+            padded[:len(chromo)] = chromo
+            match &= (games['chromo'] == padded).all(axis=1)
+        if scoring_name is not None:
+            match &= games['scoring'] == scoring_name.encode()
+        return np.flatnonzero(match)
+
+    def game_steps(self, game):
+        # every step of a game, a view into the memmap
+        g = self.games[game]
+        return self.steps[g['start']:g['start'] + g['length']]
+
+    def step(self, game, i):
+        g = self.games[game]
+        if not 0 <= i < g['length']:
+            raise IndexError('game %d has %d steps' % (game, g['length']))
+        return self.steps[g['start'] + i]
+
+    def step_across(self, games, i):
+        # step i of every one of games (those that lasted that long), copied, and which games those were
+        records = self.games[np.asarray(games, dtype=np.intp)]
+        alive = records['length'] > i
+        return self.steps[records['start'][alive] + i], np.asarray(games)[alive]
+
+    def board(self, step):
+        # a step record's board after it, in TetrisEnv's format
+        return rows_to_board(step['rows'].tolist(), self.geometry[1])
+
+    def boards(self, steps):
+        # (N, total rows, cols) boards of step records
+        bits = TetrisSIE.col_bits(self.geometry[1]).astype(steps['rows'].dtype)
+        return ((steps['rows'][:, :, None] & bits) != 0).astype(np.byte)
+
+    def iter_boards(self, game):
+        # boards of a game one at a time, for BoardVision.replay
+        for step in self.game_steps(game):
+            yield self.board(step)
+
+    def features(self, steps, names):
+        # (N, F) batched features of the boards after steps
+        return batch_features(self.boards(steps), names, self.geometry[2])
+
+    # endregion
+
+    # region writing
+    def __append_game(self, record, steps):
+        # drops what a crash left half written (steps with no game record, part of a game record)
+        games = self.games
+        end = int(games['start'][-1] + games['length'][-1]) if len(games) else 0
+        self.__steps = None
+        with open(self.steps_path, 'ab') as f:
+            f.truncate(end * self.step_dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(steps.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        record['start'] = end
+        with open(self.games_path, 'ab') as f:
+            f.truncate(len(games) * self.game_dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(record.tobytes())
+        return len(games)
+
+    def record(self, env, scoring_function, chromo, seed, num_of_iters, scoring_name=None):
+        # plays a game on env (of the corpus's geometry) and appends it, returns its id
+        if (env.MAX_TETRIS_ROWS, env.MAX_TETRIS_COLS, env.GAMEOVER_ROWS) != self.geometry:
+            raise ValueError('env geometry differs from the corpus')
+        steps = np.zeros(num_of_iters, dtype=self.step_dtype)
+        env.set_seed(seed)
+        lost = False
+        n = 0
+        for step in env.iter_run(scoring_function, chromo, num_of_iters, with_board=True):
+            s = steps[n]
+            s['piece'] = TetrisEnv.TETRIS_PIECES.index(step.piece)
+            s['col'] = step.col
+            s['rot'] = step.rot
+            s['play_score'] = step.play_score
+            s['score'] = step.score
+            s['ratings'] = step.rates
+            s['rotations'] = step.rotations
+            s['rows'] = board_to_rows(step.board)
+            lost = step.play_score < 0
+            n += 1
+        record = np.zeros(1, dtype=self.game_dtype)
+        record['seed'] = seed
+        record['chromo'][0, :len(chromo)] = chromo
+        record['scoring'] = (scoring_name or getattr(scoring_function, '__name__', '')).encode()[:32]
+        record['length'] = n
+        record['score'] = env.score
+        record['lost'] = lost
+        return self.__append_game(record, steps[:n])
+
+    # endregion
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='record games into a trace corpus, or replay one')
+    parser.add_argument('directory')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[17, 5132, 4])
+    parser.add_argument('--iters', type=int, default=600)
+    parser.add_argument('--replay', type=int, help='replay this game id in BoardVision')
+    args = parser.parse_args()
+    corpus = TraceCorpus(args.directory)
+    if args.replay is not None:
+        from Visor import BoardVision
+        vision = BoardVision(*corpus.geometry)
+        vision.replay(corpus.iter_boards(args.replay), 0.05)
+        vision.close()
+    else:
+        env = TetrisSIE.BitTetrisEnv(*corpus.geometry)
+        start = time.perf_counter()
+        for seed in args.seeds:
+            corpus.record(env, TetrisSIE.eternal_batch, TetrisSIE.eternal_chromo, seed, args.iters, 'eternal_batch')
+        print('%d games, %d steps, %.1f s' % (len(corpus), len(corpus.steps), time.perf_counter() - start))
@@ -0,0 +1,192 @@
+from random import Random
+
+import numpy as np
+
+from TetrisSIE import (TetrisEnv, PIECE_TABLE, PIECE_ROTATIONS, COLUMN_FEATURES, batch_features,
+                       collapse_stack)
+
+# region placement tables
+# every piece padded to the same number of placements (34 for T/L/J) so a step over K games
+# is one (K, 34) gather, PIECE_INDEX maps 'O'.. to the rows of these tables
+PIECE_INDEX = {p: i for i, p in enumerate(TetrisEnv.TETRIS_PIECES)}
+MAX_PLACEMENTS = max(sum(TetrisEnv.MAX_TETRIS_COLS - PIECE_TABLE[p][r].width + 1 for r in PIECE_ROTATIONS[p])
+                     for p in TetrisEnv.TETRIS_PIECES)
+PIECE_PIXELS = np.array([PIECE_TABLE[p][0].pixels for p in TetrisEnv.TETRIS_PIECES])
+NO_BOTTOM = -TetrisEnv.TOTAL_ROWS * 2  # columns a form doesn't have never decide the landing row
+
+
+def build_placement_tables():
+    num_pieces = len(TetrisEnv.TETRIS_PIECES)
+    valid = np.zeros((num_pieces, MAX_PLACEMENTS), dtype=bool)
+    cols = np.zeros((num_pieces, MAX_PLACEMENTS), dtype=np.intp)
+    rots = np.zeros((num_pieces, MAX_PLACEMENTS), dtype=np.intp)
+    bottoms = np.full((num_pieces, MAX_PLACEMENTS, 4), NO_BOTTOM, dtype=np.intp)
+    cell_r = np.zeros((num_pieces, MAX_PLACEMENTS, 4), dtype=np.intp)
+    cell_c = np.zeros((num_pieces, MAX_PLACEMENTS, 4), dtype=np.intp)
+    index = np.zeros((num_pieces, TetrisEnv.MAX_TETRIS_COLS, 4), dtype=np.intp)
+    for p, piece in enumerate(TetrisEnv.TETRIS_PIECES):
+        distinct = PIECE_ROTATIONS[piece]
+        first_of_rot = {}
+        m = 0
+        for rot in distinct:
+            form = PIECE_TABLE[piece][rot]
+            first_of_rot[rot] = m
+            for col in range(TetrisEnv.MAX_TETRIS_COLS - form.width + 1):
+                valid[p, m] = True
+                cols[p, m] = col
+                rots[p, m] = rot
+                bottoms[p, m, :form.width] = form.bottoms
+                cell_r[p, m] = form.cells[0]
+                cell_c[p, m] = [col + c for c in form.cells[1]]
+                m += 1
+        # same (col, rot) -> placement map as TetrisEnv.enumerate_placements
+        for rot in range(4):
+            form = PIECE_TABLE[piece][rot]
+            for col in range(TetrisEnv.MAX_TETRIS_COLS):
+                index[p, col, rot] = first_of_rot[rot % len(distinct)] + \
+                    min(col, TetrisEnv.MAX_TETRIS_COLS - form.width)
+    return valid, cols, rots, bottoms, cell_r, cell_c, index
+
+
+PLACE_VALID, PLACE_COLS, PLACE_ROTS, PLACE_BOTTOMS, PLACE_CELL_R, PLACE_CELL_C, PLACE_INDEX = \
+    build_placement_tables()
+
+
+# endregion
+
+
+class VecTetrisEnv:
+    # K games of TetrisEnv in lockstep: boards (K, 24, 10), one Random stream per game (so game k
+    # gets the same pieces as TetrisEnv with seeds[k]), all live games advance one piece per step
+    # (with a PieceSequences as piece_source the pieces are read from it instead, same ones)
+    def __init__(self, seeds, piece_source=None):
+        self.seeds = list(seeds)
+        self.RNGs = [Random() for _ in self.seeds]
+        self.piece_source = piece_source
+        self.reset()
+
+    def reset(self):
+        k = len(self.seeds)
+        for rng, seed in zip(self.RNGs, self.seeds):
+            rng.seed(seed)
+        self.boards = np.zeros((k, TetrisEnv.TOTAL_ROWS, TetrisEnv.MAX_TETRIS_COLS), dtype=np.byte)
+        self.pieces_drawn = 0
+        self.current_piece = self.__draw_pieces(np.arange(k))
+        self.next_piece = self.__draw_pieces(np.arange(k))
+        self.scores = np.zeros(k, dtype=np.int64)
+        self.done = np.zeros(k, dtype=bool)
+        self.steps = 0
+
+    def __draw_pieces(self, games):
+        # all live games draw together, so pieces_drawn is the same for every one of them
+        if self.piece_source is None:
+            pieces = np.array([PIECE_INDEX[self.RNGs[g].choice(TetrisEnv.TETRIS_PIECES)] for g in games],
+                              dtype=np.intp)
+        else:
+            pieces = np.array([self.piece_source.get(self.seeds[g], self.pieces_drawn + 1)[self.pieces_drawn]
+                               for g in games], dtype=np.intp)
+        self.pieces_drawn += 1
+        return pieces
+
+    def __gen_next_pieces(self, live):
+        self.current_piece[live] = self.next_piece[live]
+        self.next_piece[live] = self.__draw_pieces(np.flatnonzero(live))
+
+    def enumerate_placements(self, games):
+        # afterstates of every placement of the given games: boards (G, M, 24, 10), scores,
+        # game_over and valid (G, M), padding placements are not valid
+        boards = self.boards[games]
+        pieces = self.current_piece[games]
+        g = len(games)
+        landing = self.__landing(boards, pieces)
+
+        stack = np.repeat(boards[:, None], MAX_PLACEMENTS, axis=1)
+        rows = landing[:, :, None] + PLACE_CELL_R[pieces]
+        game_idx = np.broadcast_to(np.arange(g)[:, None, None], rows.shape)
+        place_idx = np.broadcast_to(np.arange(MAX_PLACEMENTS)[None, :, None], rows.shape)
+        stack[game_idx, place_idx, rows, PLACE_CELL_C[pieces]] = 1
+        flat, cleared = collapse_stack(stack.reshape((-1,) + stack.shape[2:]))
+        stack = flat.reshape(stack.shape)
+        cleared = cleared.reshape(g, MAX_PLACEMENTS)
+        game_over = np.any(stack[:, :, :TetrisEnv.GAMEOVER_ROWS], axis=(2, 3))
+        scores = np.asarray(TetrisEnv.LINE_SCORES)[cleared] + PIECE_PIXELS[pieces][:, None] * TetrisEnv.SCORE_PIXEL
+        scores[game_over] = TetrisEnv.GAMEOVER_PENALTY
+        return stack, scores, game_over, PLACE_VALID[pieces]
+
+    @staticmethod
+    def __landing(boards, pieces):
+        # (G, M) row every placement of pieces lands on in boards
+        g = len(boards)
+        filled = boards.any(axis=1)
+        tops = np.where(filled, np.argmax(boards, axis=1), TetrisEnv.TOTAL_ROWS)  # (G, cols)
+        span = np.minimum(PLACE_COLS[pieces][:, :, None] + np.arange(4), TetrisEnv.MAX_TETRIS_COLS - 1)
+        span_tops = np.take_along_axis(tops[:, None, :], span.reshape(g, -1)[:, None, :], axis=2)
+        landing = np.min(span_tops.reshape(span.shape) - PLACE_BOTTOMS[pieces], axis=2) - 1
+        return np.where(PLACE_VALID[pieces], np.maximum(0, landing), 0)
+
+    def step(self, games, placements, stack, scores):
+        # plays placement[i] of games[i] from an enumerate_placements stack
+        picked = np.arange(len(games))
+        play_score = scores[picked, placements]
+        after = stack[picked, placements]
+        losing = np.flatnonzero(play_score < 0)
+        if len(losing):
+            # like TetrisEnv a losing move leaves the piece stamped on the board, no rows cleared
+            lost_games = games[losing]
+            pieces = self.current_piece[lost_games]
+            spots = placements[losing]
+            boards = self.boards[lost_games]
+            rows = self.__landing(boards, pieces)[np.arange(len(losing)), spots][:, None] + \
+                PLACE_CELL_R[pieces, spots]
+            boards[np.arange(len(losing))[:, None], rows, PLACE_CELL_C[pieces, spots]] = 1
+            after[losing] = boards
+        self.boards[games] = after
+        self.scores[games] += play_score
+        lost = np.zeros(len(self.seeds), dtype=bool)
+        lost[games] = play_score < 0
+        self.done |= lost
+        live = np.zeros(len(self.seeds), dtype=bool)
+        live[games] = True
+        self.__gen_next_pieces(live)
+        return play_score
+
+    def rate(self, scoring_function, weights, games, stack, scores, game_over, valid):
+        # same (G, cols, 4) grid as a linear_scoring function gives run, one weight row per game
+        names = scoring_function.features[:weights.shape[1]]
+        board_cols = [f for f, name in enumerate(names) if name not in COLUMN_FEATURES]
+        rated = scores.astype(float)
+        alive = valid & ~game_over
+        if board_cols:
+            features = batch_features(stack[alive], [names[f] for f in board_cols])
+            game_of = np.broadcast_to(np.arange(len(games))[:, None], alive.shape)[alive]
+            rated[alive] += np.sum(features * weights[game_of][:, board_cols], axis=1)
+        asked_cols = np.arange(TetrisEnv.MAX_TETRIS_COLS)
+        col_rating = np.zeros((len(games), TetrisEnv.MAX_TETRIS_COLS))
+        for f, name in enumerate(names):
+            if name in COLUMN_FEATURES:
+                col_rating += COLUMN_FEATURES[name](asked_cols)[None, :] * weights[:, f:f + 1]
+        index = PLACE_INDEX[self.current_piece[games]]  # (G, cols, 4)
+        grid = np.take_along_axis(rated, index.reshape(len(games), -1), axis=1).reshape(index.shape)
+        over = np.take_along_axis(game_over, index.reshape(len(games), -1), axis=1).reshape(index.shape)
+        return np.where(over, grid, grid + col_rating[:, :, None]), index
+
+    def run(self, scoring_function, genetic_params, num_of_iters):
+        # genetic_params is one chromosome for all games or a (K, genes) matrix, one per game.
+        # Plays like TetrisEnv.run: first best column, first best rotation in it
+        self.reset()
+        weights = np.asarray(genetic_params, dtype=float)
+        if weights.ndim == 1:
+            weights = np.broadcast_to(weights, (len(self.seeds), len(weights)))
+        for it in range(num_of_iters):
+            games = np.flatnonzero(~self.done)
+            if len(games) == 0:
+                break
+            stack, scores, game_over, valid = self.enumerate_placements(games)
+            grid, index = self.rate(scoring_function, weights[games], games, stack, scores, game_over, valid)
+            rates = np.max(grid, axis=2)
+            pos = np.argmax(rates, axis=1)
+            picked = np.arange(len(games))
+            rot = np.argmax(grid[picked, pos], axis=1)
+            self.step(games, index[picked, pos, rot], stack, scores)
+            self.steps += 1
+        return self.scores.copy(), self.done.copy()
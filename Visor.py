@@ -1,38 +1,54 @@
+import time
 from tkinter import *
+
+import numpy as np
+
 from TetrisSIE import TetrisEnv
 
 
 class BoardVision:
     Actv = False
-    def __init__(self):
-        label_rows = []
+    CELL_SIZE = 36  # pixels
+
+    # rows (without the game over ones), cols and gameover_rows like TetrisEnv(rows, cols, ..)
+    def __init__(self, rows=TetrisEnv.MAX_TETRIS_ROWS, cols=TetrisEnv.MAX_TETRIS_COLS,
+                 gameover_rows=TetrisEnv.GAMEOVER_ROWS):
         self.window = Tk()
         # self.activate_bgm()
-        for i in range(TetrisEnv.MAX_TETRIS_ROWS + 4):
-            label_cols = []
-            for j in range(TetrisEnv.MAX_TETRIS_COLS):
-                label = Label(self.window, bg='white', width=5, height=2)
-                label.grid(row=i, column=j)
-                label_cols.append(label)
-            label_rows.append(label_cols)
-        self.label_rows = label_rows
+        rows += gameover_rows
+        self.canvas = Canvas(self.window, width=cols * self.CELL_SIZE, height=rows * self.CELL_SIZE,
+                             highlightthickness=0)
+        self.canvas.pack()
+        # one rectangle per cell, only the ones that changed get reconfigured
+        self.empty_colors = [['white'] * cols for _ in range(rows)]
+        for i in range(gameover_rows):
+            self.empty_colors[i] = ['cyan' if i & 1 == 1 else 'blue'] * cols
+        self.cells = [[self.canvas.create_rectangle(j * self.CELL_SIZE, i * self.CELL_SIZE,
+                                                    (j + 1) * self.CELL_SIZE, (i + 1) * self.CELL_SIZE,
+                                                    fill=self.empty_colors[i][j], outline='gray')
+                       for j in range(cols)] for i in range(rows)]
+        self.shown = np.zeros((rows, cols), dtype=bool)
 
     def update_board(self, board):
-
-        for i in range(TetrisEnv.MAX_TETRIS_ROWS + 4):
-            for j in range(TetrisEnv.MAX_TETRIS_COLS):
-                if board[i][j] > 0:
-                    self.label_rows[i][j].config(bg='black')
-                elif i < TetrisEnv.GAMEOVER_ROWS:
-                    if i & 1 == 1:
-                        self.label_rows[i][j].config(bg='cyan')
-                    else:
-                        self.label_rows[i][j].config(bg='blue')
-                else:
-                    self.label_rows[i][j].config(bg='white')
-
+        filled = np.asarray(board) > 0
+        for i, j in np.argwhere(filled != self.shown):
+            self.canvas.itemconfig(self.cells[i][j], fill='black' if filled[i, j] else self.empty_colors[i][j])
+        self.shown = filled
         self.window.update()
 
+    def replay(self, states, sleep_time=0.0, frame_skip=0):
+        # boards, a run trace's board_states or an iter_run(..., with_board=True) stream,
+        # only every (frame_skip + 1)th board is drawn (and always the last one)
+        state = None
+        for n, state in enumerate(states):
+            if n % (frame_skip + 1) == 0:
+                self.update_board(getattr(state, 'board', state))
+                state = None
+                if sleep_time:
+                    time.sleep(sleep_time)
+        if state is not None:
+            self.update_board(getattr(state, 'board', state))
+
     def close(self):
         self.window.destroy()
 